@@ -2,10 +2,24 @@ import streamlit as st
 import pandas as pd
 import geopandas as gpd
 import map
+import points
+import prefetch
+import profiling
+import derived
+import disk_cache
+import cartogram
+import drilldown
+import spatial
+import boundaries
+import codes
+import share
 import numpy as np
 import plotly.express as px
 import base64
 import re
+import os
+import hashlib
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 # Experimental
 # import deepseek
 
@@ -99,6 +113,17 @@ def assign_ca_level(code):
     else:
         return ''
 
+# Keep only the rows of the data at the chosen geography level
+def filter_level(df, level):
+    if 'ITL' == level[:3]:
+        level_to_length = {'ITL1': 3, 'ITL2': 4, 'ITL3': 5}
+        return df.loc[(df[df.columns[0]].str.len() == level_to_length[level]) & (df[df.columns[0]] != 'TLB')].copy()
+    elif level == 'National':
+        return df[df[df.columns[0]].isin(['TLB', 'TLL', 'TLM', 'TLN'])]
+    elif level == 'MCA':
+        return df.loc[df[df.columns[0]].str[:3].isin(['E47', 'E61'])].copy()
+    return df.loc[df[df.columns[0]].str.len() == 9].copy()
+
 # Convert image to base 64 (streamlit only displays base 64), these codes are put in styles.css
 def get_image_as_base64(file_path):
     with open(file_path, "rb") as file:
@@ -111,32 +136,605 @@ def load_css(filepath):
     with open(filepath) as f:
         st.html(f"<style>{f.read()}</style>")
 
-# Select ITL or authority, get the respective map file, construct the map figures
-@st.cache_data(show_spinner=False)
-def get_figures(df, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df, colorscale=None, show_missing_values=False, units='%', dp=2, thresholds=[], map_height=550, index=0, ):
+# Work out the geography level from the first region code, and whether the national (TLB) regions are used
+def detect_geo_level(df):
     if df.iloc[0, 0][:2] == 'TL':
-        geo_level = assign_itl_level(df.iloc[0, 0]).lower()
-        nat = False
-        if 'TLB' in list(df.iloc[:, 0]):
-            nat = True
-        map_df = make_map_itl(geo_level, itlmapping, _itl3_shapes_df, nat)
+        return assign_itl_level(df.iloc[0, 0]).lower(), 'TLB' in list(df.iloc[:, 0])
     elif len(df.iloc[0, 0]) == 9:
-        geo_level = assign_ca_level(df.iloc[0, 0]).lower()
+        return assign_ca_level(df.iloc[0, 0]).lower(), False
+    return '', False
+
+# Build the map layer (region geometries and names) for a geography level, once per level
+@st.cache_data(show_spinner=False)
+def get_map_layer(geo_level, nat, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df):
+    if disk_cache.enabled():
+        key = disk_cache.make_key('layer', geo_level, nat, [disk_cache.file_key(path) for path in SOURCE_FILES.values()])
+        map_df = disk_cache.get_object(key)
+        if map_df is not None:
+            return map_df
+    if geo_level[:3] == 'itl':
+        map_df = make_map_itl(geo_level, itlmapping, _itl3_shapes_df, nat)
+    else:
         map_df = make_map_authorities(geo_level, mcamapping, _la_shapes_df)
+    if disk_cache.enabled():
+        disk_cache.put_object(key, 'layer', map_df)
+    return map_df
+
+# Parent -> child region codes for each step down the ITL hierarchy, built once from the mapping file
+@st.cache_data(show_spinner=False)
+def get_itl_hierarchy(itlmapping):
+    return drilldown.build_hierarchy(itlmapping)
+
+# Geometries of one region's children, cut from the child level's layer once per region drilled into
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_child_layer(geo_level, parent, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df):
+    map_df = get_map_layer(geo_level, False, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    return drilldown.get_children_layer(map_df, get_itl_hierarchy(itlmapping), geo_level, parent)
+
+# Write a built-in map layer's GeoJSON to the static folder once, so the browser downloads it a single time however many
+# subplots use it. Only for the built-in layers, which are the same for every user: the layer is identified by its level
+@st.cache_data(show_spinner=False)
+def get_layer_geojson_url(geo_level, nat, _map_df):
+    geojson = _map_df.to_json(drop_id=True)
+    filename = f"{geo_level}_{hashlib.sha256(geojson.encode()).hexdigest()[:16]}.geojson"
+    os.makedirs('static/layers', exist_ok=True)
+    path = os.path.join('static/layers', filename)
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            f.write(geojson)
+    return f"app/static/layers/{filename}"
+
+# Select ITL or authority, get the respective map file, construct the map figures.
+# With a parent (drilling down) only the parent's child regions are drawn. With an uploaded boundary layer (identified by
+# boundary_key) its regions are drawn instead of the built-in ones; they have no hex layout so use the standard map
+@st.cache_data(show_spinner=False)
+def get_figures(df, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df, colorscale=None, show_missing_values=False, units='%', dp=2, thresholds=[], map_height=550, index=0, renderer='geo', parent=None, boundary_key=None, _boundary_layer=None):
+    if boundary_key:
+        geo_level, nat = boundaries.CODE_COLUMN, False
+        renderer = 'geo' if renderer == 'hex' else renderer
     else:
+        geo_level, nat = detect_geo_level(df)
+    if not geo_level:
         return [], []
     df = df.rename(columns={df.columns[0]: geo_level})
     mapnames = list(df.set_index(geo_level).columns)
-    fig = map.make_choropleths(df.set_index(geo_level), map_df, geo_level, colorscale, show_missing_values, units, dp, thresholds, map_height, index)
+    # Hex maps only need their stored layout, not the map layer
+    if renderer == 'hex':
+        layout = cartogram.get_hex_layout(geo_level, nat, cartogram.match_vintage(geo_level, df[geo_level].dropna()))
+        if parent:
+            layout = layout[layout.index.isin(get_itl_hierarchy(itlmapping)[geo_level].get(parent, []))]
+        fig = map.make_cartogram(df.set_index(geo_level), layout, geo_level, colorscale, show_missing_values, units, dp, thresholds, map_height, index)
+        return fig, mapnames
+    # With a shared cache, a figure another replica has already drawn is read back instead of rebuilt
+    if disk_cache.enabled():
+        key = disk_cache.make_key('figure', df, colorscale, show_missing_values, units, dp, thresholds, map_height, index, renderer, parent, boundary_key, [disk_cache.file_key(path) for path in SOURCE_FILES.values()])
+        fig = disk_cache.get_figure(key)
+        if fig is not None:
+            return fig, mapnames
+    if boundary_key:
+        map_df = _boundary_layer
+    elif parent:
+        map_df = get_child_layer(geo_level, parent, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    else:
+        map_df = get_map_layer(geo_level, nat, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    fig = map.make_choropleths(df.set_index(geo_level), map_df, geo_level, colorscale, show_missing_values, units, dp, thresholds, map_height, index, renderer)
+    if disk_cache.enabled():
+        disk_cache.put_figure(key, fig)
     return fig, mapnames
 
+# Neighbours of every region of a level (queen or rook contiguity), found from the boundaries once per level
+@st.cache_data(show_spinner=False)
+def get_spatial_weights(geo_level, nat, contiguity, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df):
+    if disk_cache.enabled():
+        key = disk_cache.make_key('weights', geo_level, nat, contiguity, 'drawn regions', [disk_cache.file_key(path) for path in SOURCE_FILES.values()])
+        weights = disk_cache.get_object(key)
+        if weights is not None:
+            return weights
+    map_df = get_map_layer(geo_level, nat, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    if 'region_type' in map_df.columns:
+        # The grey non-MCA background never has data, so MCAs only bordering it would be left without neighbours
+        map_df = map_df[map_df['region_type'] != 'non_mca'].reset_index(drop=True)
+    weights = spatial.contiguity_weights(map_df, geo_level, contiguity)
+    if disk_cache.enabled():
+        disk_cache.put_object(key, 'weights', weights)
+    return weights
+
+# Global Moran's I and local clusters (hot and cold spots) for one column, or None if they can't be worked out
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_spatial_stats(df, index, contiguity, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df):
+    geo_level, nat = detect_geo_level(df)
+    if not geo_level:
+        return None
+    weights = get_spatial_weights(geo_level, nat, contiguity, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    return spatial.spatial_autocorrelation(map.clean_values(df.set_index(df.columns[0]).iloc[:, index]), weights)
+
+# Hot and cold spot map for a column, on the same layer (or drilled down slice of it) as get_figures. Hex maps have no
+# boundaries to show neighbours by, so the standard map is drawn instead
+@st.cache_data(show_spinner=False)
+def get_hotspot_figure(df, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df, show_missing_values=False, map_height=550, index=0, contiguity='queen', renderer='geo', parent=None):
+    geo_level, nat = detect_geo_level(df)
+    stats = get_spatial_stats(df, index, contiguity, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    if parent:
+        map_df = get_child_layer(geo_level, parent, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    else:
+        map_df = get_map_layer(geo_level, nat, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    title = f"Hot and cold spots: {df.columns[index + 1]}"
+    fig = map.make_cluster_map(stats['local']['cluster'], spatial.CLUSTERS, map_df, geo_level, title, show_missing_values, map_height, 'geo' if renderer == 'hex' else renderer)
+    return fig, list(df.columns[1:])
+
+# Construct a grid of maps for several columns, built on the same map layer as get_figures
+@st.cache_data(show_spinner=False)
+def get_grid_figure(df, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df, columns, colorscale=None, show_missing_values=False, units='%', dp=2, thresholds=[], shared_scale=True, map_height=550, boundary_key=None, _boundary_layer=None):
+    geo_level, nat = (boundaries.CODE_COLUMN, False) if boundary_key else detect_geo_level(df)
+    if not geo_level or not columns:
+        return []
+    if boundary_key:
+        map_df = _boundary_layer
+    else:
+        map_df = get_map_layer(geo_level, nat, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df)
+    # Uploaded boundaries stay in the figure rather than the public static folder, where other sessions could reach them
+    geojson_url = None if boundary_key else get_layer_geojson_url(geo_level, nat, map_df)
+    df = df.rename(columns={df.columns[0]: geo_level}).set_index(geo_level)
+    return map.make_choropleth_grid(df, map_df, geo_level, columns, colorscale, show_missing_values, units, dp, thresholds, shared_scale, map_height, geojson=geojson_url)
+
+# Current (2025) ITL3 codes, from the local authority lookup. The ITL3 boundary file also has the 2021 regions, which overlap them
+@st.cache_data(show_spinner=False)
+def get_current_itl3_codes():
+    return pd.read_csv(codes.LA_ITL_MAPPING_FILE, encoding='utf-8-sig')['itl3'].dropna().unique()
+
+# Assign uploaded points to regions and aggregate them to the requested level
+@st.cache_data(show_spinner=False)
+def get_point_aggregates(points_df, x_col, y_col, crs, level, how, value_cols, mcamapping, _la_shapes_df, itlmapping, _itl3_shapes_df):
+    if level[:3] == 'itl':
+        return points.aggregate_points(points_df, x_col, y_col, crs, level, how, value_cols, _itl3_shapes_df, 'ITL325CD', itlmapping, mcamapping, get_current_itl3_codes())
+    return points.aggregate_points(points_df, x_col, y_col, crs, level, how, value_cols, _la_shapes_df, 'LAD24CD', itlmapping, mcamapping)
+
+# Read an overlay file and precompute its clusters for every zoom level, once per file and choice of columns
+@st.cache_data(show_spinner=False, max_entries=4)
+def get_point_clusters(file_id, x_col, y_col, crs, _overlay_file):
+    overlay_df = pd.read_csv(_overlay_file, usecols=[x_col, y_col], low_memory=False)
+    _overlay_file.seek(0)
+    return points.build_cluster_levels(overlay_df, x_col, y_col, crs)
+
+# Identify a dataset by its column names and contents
+def dataset_fingerprint(df):
+    return (tuple(df.columns), int(pd.util.hash_pandas_object(df, index=False).sum()))
+
+# Identify a dataset's regions by its code column, so state tied to them (drill downs, uploaded boundaries) survives
+# renaming and adding columns but not loading other regions
+def region_codes_key(df):
+    return int(pd.util.hash_pandas_object(df.iloc[:, 0], index=False).sum())
+
+# Property names in an uploaded boundary file, once per file
+@st.cache_data(show_spinner=False, max_entries=8)
+def get_boundary_fields(file_id, _boundary_file):
+    return boundaries.read_fields(_boundary_file.getvalue(), _boundary_file.name)
+
+# An uploaded boundary file run through the preprocessing pipeline, once per file contents and choice of properties.
+# Returns the layer with a key identifying it
+@st.cache_data(show_spinner=False, max_entries=8)
+def get_boundary_layer(file_hash, code_property, name_property, _data, filename):
+    key = f"{file_hash}:{code_property}:{name_property}"
+    if disk_cache.enabled():
+        cache_key = disk_cache.make_key('boundaries', key)
+        layer = disk_cache.get_object(cache_key)
+        if layer is not None:
+            return key, layer
+    layer = boundaries.prepare_boundaries(_data, filename, code_property, name_property)
+    if disk_cache.enabled():
+        disk_cache.put_object(cache_key, 'boundaries', layer)
+    return key, layer
+
+# Legacy code translations and the codes the maps know, built once from the mapping files
+@st.cache_data(show_spinner=False)
+def get_code_index(itlmapping, mcamapping):
+    la_itlmapping = pd.read_csv(codes.LA_ITL_MAPPING_FILE, encoding='utf-8-sig')
+    return codes.build_code_index(itlmapping, mcamapping, la_itlmapping)
+
+# List every region code changed when cleaning an upload, and any still not recognised
+def show_code_report(report):
+    if report.empty:
+        return
+    changed = (report['Original'] != report['Code']).sum()
+    unmatched = report['Change'].str.contains('Not recognised|Abolished').sum()
+    with st.expander(f"Region codes: {changed} cleaned or translated, {unmatched} not on the map", expanded=unmatched > 0):
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
+# A shared map's dataset, read from the store once per link
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_shared_dataset(key):
+    return share.load_dataset(key)
+
+# Evaluate a derived map's expression over the dataset. Cached by expression and dataset fingerprint, so the frame itself is never hashed
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_derived_values(expression, fingerprint, _df):
+    compiled, used = derived.compile_expression(expression, tuple(_df.columns[1:]))
+    return derived.evaluate_expression(_df, compiled, used).to_numpy()
+
+# Queue background builds of the neighbouring and most popular columns and of the other geography levels, so stepping
+# through maps hits the figure cache. Anything still queued from an older dataset or style is cancelled
+def prefetch_figures(full_df, df, levels, level, index, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, colorscale, show_missing_values, units, dp, map_height, renderer='geo', parent=None, boundary=(None, None)):
+    ctx = get_script_run_ctx()
+    if ctx is None or df.empty:
+        return
+    columns = list(df.columns[1:])
+    dataset = dataset_fingerprint(full_df)
+    if st.session_state.get('last_choice') != (dataset, columns[index]):
+        st.session_state.last_choice = (dataset, columns[index])
+        prefetch.record_choice(dataset, columns[index])
+
+    style = (tuple(colorscale), show_missing_values, units, dp, map_height, renderer)
+    figure_args = (mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, colorscale, show_missing_values, units, dp, [], map_height)
+    candidates = [index + 1, index - 1] + [columns.index(column) for column in prefetch.popular_columns(dataset, columns)]
+    jobs = []
+    for candidate in dict.fromkeys(candidates):
+        if 0 <= candidate < len(columns) and candidate != index:
+            jobs.append((get_figures, (df,) + figure_args + (candidate, renderer, parent) + boundary))
+    for other_level in levels:
+        if other_level != level:
+            # Every argument is passed, as in the foreground call, since the cache key only covers the arguments given.
+            # Another level starts undrilled, and levels only come with the built-in boundaries
+            jobs.append((get_figures, (filter_level(full_df, other_level),) + figure_args + (index, renderer, None, None, None)))
+    prefetch.schedule(ctx.session_id, (dataset, level, parent, index, style), jobs)
+
+# Profile all the metric columns of a dataset in one pass
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_profile(df):
+    return profiling.profile_dataset(df)
+
+# Region code -> name lookup for every level, used to label rankings
+@st.cache_data(show_spinner=False)
+def get_region_names(itlmapping, mcamapping):
+    names = {'TLB': 'England'}
+    for level in ['itl1', 'itl2', 'itl3']:
+        names.update(itlmapping.drop_duplicates(level).set_index(level)[f'{level}name'].to_dict())
+    for level in ['la', 'mca']:
+        names.update(mcamapping.dropna(subset=[level]).drop_duplicates(level).set_index(level)[f'{level}name'].to_dict())
+    return names
+
+# Panel with the selected column's statistics, top and bottom regions and distribution, plus an overview of every column
+def show_summary(data_profile, column, region_names, units, dp):
+    data_format, unit = map.get_data_format(units, dp)
+    stats = data_profile['stats'].loc[column]
+
+    def format_value(value):
+        return '' if pd.isna(value) else f"{unit}{value:{data_format}}"
+
+    def ranking(values):
+        return pd.DataFrame({
+            'Region': [region_names.get(code, code) for code in values.index],
+            'Value': [format_value(value) for value in values]
+        })
+
+    with st.expander(label="**Data summary**", expanded=False):
+        stat_cols = st.columns(6)
+        stat_cols[0].metric("Regions with data", int(stats['count']))
+        stat_cols[1].metric("Missing", int(stats['missing']))
+        stat_cols[2].metric("Minimum", format_value(stats['min']))
+        stat_cols[3].metric("Median", format_value(stats['p50']))
+        stat_cols[4].metric("Mean", format_value(stats['mean']))
+        stat_cols[5].metric("Maximum", format_value(stats['max']))
+
+        rank_col1, rank_col2, hist_col = st.columns([1, 1, 2])
+        with rank_col1:
+            st.markdown("###### Highest")
+            st.dataframe(ranking(data_profile['top'][column]), hide_index=True, use_container_width=True)
+        with rank_col2:
+            st.markdown("###### Lowest")
+            st.dataframe(ranking(data_profile['bottom'][column]), hide_index=True, use_container_width=True)
+        with hist_col:
+            st.markdown("###### Distribution")
+            histogram = data_profile['histograms'][column]
+            # Bins are labelled by their lower edge, rounded to suit the bin width rather than the map's decimal places
+            # (which can round every edge to the same label), and kept as numbers so they stay in numeric order
+            width = histogram.index[1] - histogram.index[0] if len(histogram) > 1 else 0
+            if np.isfinite(width) and width > 0:
+                histogram.index = np.round(histogram.index, max(0, 1 - int(np.floor(np.log10(width)))))
+            st.bar_chart(histogram, x_label=column if len(column) < 60 else '', y_label='Regions')
+
+        st.markdown("###### All maps in this dataset")
+        st.dataframe(data_profile['stats'], use_container_width=True)
+
+# One line on whether the map's values cluster, from global Moran's I
+def show_spatial_summary(spatial_stats, contiguity):
+    if spatial_stats is None:
+        st.info("Hot and cold spots need at least three regions with different values.")
+        return
+    moran = spatial_stats['moran']
+    if moran['p_value'] > 0.05:
+        verdict = "no clear spatial pattern"
+    elif moran['i'] > moran['expected']:
+        verdict = "similar values cluster together"
+    else:
+        verdict = "neighbouring regions tend to differ"
+    st.markdown(f"**Moran's I** = {moran['i']:.3f} (p = {moran['p_value']:.3f}, {moran['regions']} regions, {contiguity} contiguity): {verdict}. "
+                f"Hot spots are high values surrounded by high values, cold spots low values surrounded by low values.")
+
+# Map styling options and the map itself. A fragment, so changing colours, thresholds, units, decimal places, size or
+# map type only reruns this function instead of the whole app; dataset choices outside it still rerun everything.
+# Called inside the sidebar so its widgets appear there, and draws the map and summary into placeholders in the main page.
+# A map that can be clicked to drill down is a widget, which a fragment can't draw outside itself, so then the figure is
+# left for main() to draw and a change of style reruns the whole app
+@st.fragment
+def show_map(df, mapname, map_index, fig, levels, level, grid_columns, shared_scale, query_params, overlay_options, overlay_file, figure, figure_loading, summary, parent=None, clickable=False, boundary=(None, None), shared_style=None):
+    mcamapping, la_shapes_df, itlmapping, itl3_shapes_df = load_files()
+    # Style from a shared link, used as the defaults of the options below
+    style = shared_style or {}
+    st.markdown("---")  # This creates a basic horizontal line (divider)
+    unit_options = ['None', '%', '£', '$', '€']
+    if 'unit' in query_params:
+        if query_params['unit'] in unit_options:
+            map_units = unit_options.index(query_params['unit'])
+        else:
+            map_units = 0
+    else:
+        map_units = 0
+    if 'unit' in style:
+        map_units = unit_options.index(style['unit'])
+    unit = st.selectbox("Select units", options=unit_options, index=map_units)
+
+    dp_options = list(range(6))
+    if 'dp' in query_params:
+        try:
+            map_dp = min(max(float(query_params['dp']), 0), 5)
+        except:
+            map_dp = 0
+    else:
+        map_dp = 0
+    if 'dp' in style:
+        map_dp = style['dp']
+    dp = st.select_slider("Select decimal places", options=dp_options, value=map_dp)
+    show_missing_values = st.toggle(label='Hide the rest of the UK', value=style.get('hide_missing', False))
+    if 'size' in query_params:
+        try:
+            map_size = min(max(float(query_params['size']), 0.25), 2)
+        except:
+            map_size = 1
+    else:
+        map_size = 1
+    if 'size' in style:
+        map_size = style['size']
+    map_height = st.slider("Adjust map size", min_value=0.25, max_value=float(2), value=float(map_size), step=0.01) * 550
+    # WebGL maps pan and hover smoothly with many regions (e.g. local authorities) and hex maps give every region the
+    # same size with a tiny payload. ?renderer=webgl or ?renderer=hex picks one by default
+    renderer_options = {'Standard': 'geo', 'WebGL': 'map', 'Hex map': 'hex'}
+    renderer_default = {'webgl': 1, 'hex': 2}.get(query_params.get('renderer'), 0)
+    if 'renderer' in style:
+        renderer_default = list(renderer_options.values()).index(style['renderer'])
+    renderer = renderer_options[st.selectbox("Map type", options=list(renderer_options), index=renderer_default)]
+    # Local Moran clusters in place of the values, with global Moran's I above the summary
+    hotspots = st.toggle(label='Show hot and cold spots', value=False, disabled=bool(grid_columns) or boundary[0] is not None)
+    contiguity_options = {'Touching regions (queen)': 'queen', 'Regions sharing a border (rook)': 'rook'}
+    contiguity = 'queen'
+    if hotspots:
+        contiguity = contiguity_options[st.selectbox("Neighbours", options=list(contiguity_options))]
+    st.markdown("---")  # This creates a basic horizontal line (divider)
+    # Colour change options
+    discrete_colours = st.toggle(label='Use discrete colouring', value='thresholds' in style)
+    default_colours = ['#440255', '#39538b', '#26828e', '#47be6d', '#f4e625', '#ffffff']
+    colour_defaults = style.get('colours', []) + default_colours[len(style.get('colours', [])):]
+    num_colours = st.slider("Number of Colours", min_value=2, max_value=6, value=len(style.get('colours', default_colours[:5])))
+
+    # Profile of every column, computed once per dataset; the sidebar defaults read from it instead of rescanning df
+    if not df.empty and mapname:
+        data_profile = get_profile(df)
+        column_stats = data_profile['stats'].loc[mapname[map_index]]
+
+    # Colour pickers
+    colours = []
+    # Create two columns in the sidebar using container
+    with st.container():
+        if discrete_colours:
+            # Create evenly spaced thresholds
+            if not df.empty and mapname:
+                min_val = column_stats['min']
+                max_val = column_stats['max']
+                thresholds = np.linspace(min_val, float(max_val), num_colours+1)
+            else:
+                thresholds = np.linspace(0, 100, num_colours+1)
+                min_val = 0
+                max_val = 100
+            if any(np.isnan(x) for x in thresholds):
+                thresholds = np.linspace(0, 100, num_colours+1)
+                min_val = 0
+                max_val = 100
+            thresholds = [round(x, 5) for x in thresholds]
+            # A shared map's thresholds, for the column they were set on
+            if len(style.get('thresholds', [])) == num_colours + 1 and style.get('index', 0) == map_index:
+                thresholds = list(style['thresholds'])
+            colour_column1, colour_column2, colour_column3, colour_column4, colour_column5 = st.columns(5)  # Create two columns
+            step = float(10**-(dp+1))
+            for i in range(1, num_colours + 1):
+                if i > 3:
+                    if i == 4:
+                        if num_colours != i:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        else:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                    elif i == 5:
+                        if num_colours != i:
+                            with colour_column1:
+                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
+                            with colour_column2:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column3:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        else:
+                            with colour_column1:
+                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
+                            with colour_column2:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column3:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                    else:
+                        if num_colours != i:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        else:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                else:
+                    if i == 1:
+                        with colour_column1:
+                            thresholds[i-1] = st.number_input('<', max_value=float(thresholds[i] - step/10), value=float(thresholds[i-1]), step=step, key=f'-input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        with colour_column2:
+                            colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                        with colour_column3:
+                            thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                    elif i == 2:
+                        if num_colours != i:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        else:
+                            with colour_column4:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column5:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                    elif i == 3:
+                        if num_colours != i:
+                            with colour_column1:
+                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
+                            with colour_column2:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column3:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                        else:
+                            with colour_column1:
+                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
+                            with colour_column2:
+                                colour = st.color_picker(f"-", colour_defaults[i-1], label_visibility='hidden')
+                            with colour_column3:
+                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
+                colours.append(colour)
+                # print(float(thresholds[i]))
+            custom_colour_scale = colours
+        else:
+            thresholds=[]
+            colour_column1, colour_column2 = st.columns(2)  # Create two columns
+            for i in range(num_colours):
+                if i > 2:
+                    with colour_column2:  # Use the second column for colours after index 2
+                        if i == 3:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        elif i == 4:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        else:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        colours.append(colour)
+                else:
+                    with colour_column1:  # Use the first column for the first 3 colours
+                        if i == 0:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        elif i == 1:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        elif i == 2:
+                            colour = st.color_picker(f"Pick Colour {i+1}", colour_defaults[i])
+                        colours.append(colour)
+
+            custom_colour_scale = generate_colour_scale(colours)
+    st.markdown("---")  # This creates a basic horizontal line (divider)
+
+    if clickable and get_script_run_ctx().fragment_ids_this_run:
+        st.rerun()
+
+    # Labeling options
+    if fig:
+        # Save session state variables and load figure
+        with figure_loading.container():
+            with st.spinner('Loading map...'):
+                if grid_columns:
+                    grid_fig = get_grid_figure(df, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, grid_columns, custom_colour_scale, show_missing_values, unit, dp, thresholds, shared_scale, map_height, *boundary)
+                    figure.plotly_chart(grid_fig, use_container_width=True,
+                        config = {
+                            'toImageButtonOptions': {
+                                'filename': "TPI_UK_Colour_Map_grid",
+                                'scale': 2
+                            }
+                        }
+                    )
+                else:
+                    spatial_stats = get_spatial_stats(df, map_index, contiguity, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df) if hotspots and not df.empty else None
+                    if spatial_stats:
+                        st.session_state.fig, st.session_state.mapname = get_hotspot_figure(df, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, show_missing_values, map_height, map_index, contiguity, renderer, parent)
+                    else:
+                        st.session_state.fig, st.session_state.mapname = get_figures(df, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, custom_colour_scale, show_missing_values, unit, dp, thresholds, map_height, map_index, renderer, parent, *boundary)
+                    if overlay_options and st.session_state.fig and renderer != 'hex':
+                        try:
+                            cluster_levels = get_point_clusters(*overlay_options, overlay_file)
+                            map.add_point_overlay(st.session_state.fig, points.choose_cluster_level(cluster_levels, map_height), renderer=renderer)
+                        except (ValueError, KeyError):
+                            st.error("Point overlay could not be read: check the coordinate columns")
+                    if not clickable:
+                        figure.plotly_chart(st.session_state.fig, use_container_width=True,
+                            config = {
+                                'toImageButtonOptions': {
+                                    'filename': f"TPI_UK_Colour_Map_{st.session_state.mapname[map_index].replace(' ','_')}",
+                                    'scale': 2
+                                }
+                            }
+                        )
+
+        # Summary statistics and rankings for the data behind the map
+        if not df.empty and st.session_state.mapname:
+            with summary.container():
+                if hotspots and not grid_columns:
+                    show_spatial_summary(spatial_stats, contiguity)
+                region_names = get_region_names(itlmapping, mcamapping)
+                if boundary[1] is not None:
+                    region_names = {**region_names, **dict(zip(boundary[1][boundaries.CODE_COLUMN], boundary[1]['region']))}
+                show_summary(get_profile(df), st.session_state.mapname[map_index], region_names, unit, dp)
+
+        # Prebuild the maps the user is likely to look at next while they look at this one
+        if not grid_columns and not hotspots and len(thresholds) == 0 and st.session_state.mapname:
+            prefetch_figures(st.session_state.df, df, levels, level, map_index, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, custom_colour_scale, show_missing_values, unit, dp, map_height, renderer, parent, boundary)
+
+        # Put a link to this map, as styled, in the address bar. The dataset is stored by its contents, so the link works
+        # for uploaded data and anyone opening it gets the figure from the cache
+        if not grid_columns and st.session_state.mapname and not st.session_state.df.empty:
+            if st.button("Share this map", disabled=boundary[0] is not None, help="Maps of uploaded boundaries can't be shared"):
+                try:
+                    link = {
+                        'map': share.save_dataset(st.session_state.df),
+                        'style': share.encode_style({
+                            'unit': unit, 'dp': dp, 'size': round(map_height / 550, 2), 'renderer': renderer, 'hide_missing': show_missing_values,
+                            'colours': colours, 'thresholds': [float(x) for x in thresholds] if discrete_colours else None,
+                            'levels': levels or None, 'level': level or None, 'index': map_index
+                        })
+                    }
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    st.query_params.from_dict(link)
+                    st.session_state.shared_link = (link['map'], link['style'])  # Already open here, so not loaded again
+                    st.success("The address bar now links to this map: copy it to share the map.")
+
+# Boundary and mapping files every map is built from
+SOURCE_FILES = {
+    'mcamapping': 'src/mcamapping.csv',
+    'la_shapes': 'src/Local_Authority_Districts_December_2024_Boundaries_UK_BUC_-2087974657986281540.geojson',
+    'itlmapping': 'src/itlmapping-updated.csv',
+    'itl3_shapes': 'src/International_Territorial_Level_3_Updated.geojson'
+}
+
 # Preload files
 @st.cache_data(show_spinner=False)
 def load_files():
-    mcamapping = pd.read_csv('src/mcamapping.csv')
-    la_shapes_df = gpd.read_file('src/Local_Authority_Districts_December_2024_Boundaries_UK_BUC_-2087974657986281540.geojson')
-    itlmapping = pd.read_csv('src/itlmapping-updated.csv')
-    itl3_shapes_df = gpd.read_file('src/International_Territorial_Level_3_Updated.geojson')
+    mcamapping = pd.read_csv(SOURCE_FILES['mcamapping'])
+    la_shapes_df = gpd.read_file(SOURCE_FILES['la_shapes'])
+    itlmapping = pd.read_csv(SOURCE_FILES['itlmapping'])
+    itl3_shapes_df = gpd.read_file(SOURCE_FILES['itl3_shapes'])
     return mcamapping, la_shapes_df, itlmapping, itl3_shapes_df
     
 def main():
@@ -149,6 +747,27 @@ def main():
     mcamapping, la_shapes_df, itlmapping, itl3_shapes_df = load_files()
 
     query_params = {k.lower(): v.lower() for k, v in st.query_params.items()}
+    # Open a shared map once per session: its dataset from the store, and its style as the sidebar's defaults. The style
+    # is kept with the dataset's regions, so it stops applying once other data is loaded
+    shared_link = (st.query_params.get('map'), st.query_params.get('style', ''))
+    if shared_link[0] and st.session_state.get('shared_link') != shared_link:
+        st.session_state.shared_link = shared_link
+        try:
+            shared_df = get_shared_dataset(shared_link[0])
+            shared_style = share.decode_style(shared_link[1]) if shared_link[1] else {}
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            shared_levels = shared_style.get('levels', [])
+            st.session_state.df = shared_df
+            st.session_state.fig = True
+            st.session_state.mapname = shared_df.columns[1:].tolist()
+            st.session_state.levels = shared_levels
+            st.session_state.level = shared_style.get('level', '') if not shared_levels or shared_style.get('level') in shared_levels else shared_levels[0]
+            st.session_state.index = shared_style.get('index', 0)
+            st.session_state.boundaries = None
+            st.session_state.selected_button = None
+            st.session_state.shared_style = (region_codes_key(shared_df), shared_style)
     if 'dvo' in st.session_state:
         dvo = st.session_state.dvo
     else:
@@ -212,17 +831,26 @@ def main():
             - **Upload your data**: Click *Browse Files* below, locate your file, and then press *Upload File*.
             - **Customise your map**: Use the options on the sidebar to alter the colour, view, and units.
 
+            ##### Files of point locations (e.g. firm sites with latitude/longitude or easting/northing) can be uploaded too: open *Point data options*, pick the coordinate columns and the level to aggregate to, and each point will be counted, summed or averaged into the region it falls in.
+            ##### Region codes are cleaned up on upload: spaces, hidden characters and lower case letters are removed, and older codes are translated to current ones (NUTS codes such as UKC11 to ITL codes such as TLC11, Scottish LAU1 codes to council area codes, and districts abolished in 2023 to the unitary authority they joined). Every change, and any code still not recognised, is listed under *Region codes* after uploading.
+            ##### To map regions the tool doesn't include (e.g. wards, constituencies or health boards), open *Custom boundaries* and upload their boundaries as a GeoJSON or zipped shapefile (up to 50MB and 20,000 regions), choose the property holding the region codes used in your data, then upload your data as usual.
+
             ##### If you want to see some examples of what this tool can do, select one of the pre-existing data sets below.
 
             ### Customisation Options
             #### Map navigation
             - **Select map**: shows the list of maps produced from the data selected. The names of the maps are the respective column names in the data file.
             - **Change title**: rename the map you are currently working on. (Character limit: 70)
+            - **Add a derived map**: create a new map from the existing columns, e.g. the difference between two years or a ratio, by writing an expression with column names in backticks such as `` `Exports` / `Imports` ``.
             - **Select geography level**: if your map has 2 or more different types of region codes in the first column, these types will show up in this menu allowing you to choose which type to use.
+            - **Drill down**: if your data has ITL1 and ITL2 (or ITL2 and ITL3) regions, click a region on the map to see only the regions inside it at the next level. Use **Back up a level** above the map to return.
+            - **Share this map**: puts a link to the map, with its data and all its options (colours, thresholds, units, level, column and title), in your browser's address bar. Anyone opening the link sees the same map, including maps of uploaded data.
             #### Formatting
             - **Select units**: choose the units you wish to use from this menu. The selected unit will format the hover data and colourscale/key.
             - **Select decimal places**: choose the number of decimal places you would like your data to be rounded to. The selected number of decimal places will format the hover data and colourscale/key.
             - **Hide the rest of the UK**: enabling this will remove any regions missing data in the map.
+            - **Map type**: *Standard* draws region boundaries. *WebGL* draws the same map with WebGL, which keeps panning and hovering smooth on detailed maps such as local authorities. *Hex map* gives every region one equal sized hexagon, so small urban regions are as visible as large rural ones, and loads much faster. Add `?renderer=webgl` or `?renderer=hex` to the link to choose one by default.
+            - **Show hot and cold spots**: colour regions by local Moran's I instead: *hot spots* are high values next to other high values, *cold spots* low values next to low values, and *High-Low*/*Low-High* regions stand out from their neighbours (5% significance, by permutation). Above the data summary, global Moran's I says whether similar values cluster across the whole map. **Neighbours** chooses whether regions meeting at a corner count as neighbours (queen) or only those sharing a border (rook).
             #### Colour options
             - **Use discrete colouring**: enable this to use solid colouring within specified bounds. Here you will be given the option to classify your data into coloured categories based on the bounds you select. Precise data will be inflated to account for the small increments.
             - **Number of colours**: choose the number of colours used to define the colour scale/colour categories. (minimum 2, maximum 6)
@@ -231,8 +859,10 @@ def main():
             )
 
     # Placeholders for the maps
+    breadcrumb = st.empty()
     figure = st.empty()
     figure_loading = st.empty()
+    summary = st.empty()
     # Save space for the map while it is switching states
     if fig:
         figure.markdown(
@@ -431,6 +1061,45 @@ def main():
 
     upload_file = st.file_uploader("Upload a file", type=["csv"])
 
+    # Options for files of point locations (e.g. firm sites) rather than region codes
+    point_options = None
+    with st.expander(label="Point data options", expanded=False):
+        point_data = st.toggle(label='My file contains point locations instead of region codes', value=False)
+        if point_data and upload_file:
+            try:
+                point_columns = pd.read_csv(upload_file, nrows=0).columns.tolist()
+            except Exception:
+                point_columns = []
+            upload_file.seek(0)
+            point_col1, point_col2 = st.columns(2)
+            with point_col1:
+                point_crs = st.selectbox("Coordinates", options=list(points.POINT_CRS.keys()))
+                x_col = st.selectbox("Longitude/easting column", options=point_columns)
+                y_col = st.selectbox("Latitude/northing column", options=point_columns, index=min(1, max(len(point_columns) - 1, 0)))
+            with point_col2:
+                point_level = st.selectbox("Aggregate to", options=['ITL3', 'ITL2', 'ITL1', 'LA', 'MCA'])
+                point_how = st.selectbox("Aggregation", options=['count', 'sum', 'mean'])
+                value_cols = st.multiselect("Columns to aggregate", options=[col for col in point_columns if col not in [x_col, y_col]], disabled=point_how == 'count')
+            point_options = (x_col, y_col, points.POINT_CRS[point_crs], point_level.lower(), point_how, value_cols)
+
+    # Boundaries for regions the tool doesn't include (wards, constituencies, health boards...), uploaded with the data
+    boundary_options = None
+    with st.expander(label="Custom boundaries", expanded=False):
+        boundary_file = st.file_uploader("Upload boundaries (GeoJSON or zipped shapefile)", type=["geojson", "json", "zip"], key='boundary_file')
+        if boundary_file:
+            try:
+                boundary_fields = get_boundary_fields(boundary_file.file_id, boundary_file)
+            except ValueError as e:
+                boundary_fields = []
+                st.error(str(e))
+            if boundary_fields:
+                boundary_col1, boundary_col2 = st.columns(2)
+                with boundary_col1:
+                    code_property = st.selectbox("Region code property", options=boundary_fields, help="Must match the codes in the first column of your data")
+                with boundary_col2:
+                    name_property = st.selectbox("Region name property", options=['None'] + boundary_fields)
+                boundary_options = (boundary_file, code_property, None if name_property == 'None' else name_property)
+
     # Button to confirm the selection
     if st.button("Upload File"):
         if upload_file:
@@ -441,6 +1110,15 @@ def main():
                     st.error("Uploaded CSV is empty")
                 else:
                     st.success(f"Successfully loaded {upload_file.name}")
+                    if point_options:
+                        with st.spinner('Assigning points to regions...'):
+                            df, unassigned, outside_level = get_point_aggregates(df, *point_options, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df)
+                        if unassigned > 0:
+                            st.warning(f"{unassigned} points could not be placed in a UK region and were left out.")
+                        if outside_level > 0:
+                            st.info(f"{outside_level} points are in areas outside every {point_options[3].upper()} region and were left out.")
+                        if df.empty:
+                            st.error(f"None of the points fall within a {point_options[3].upper()} region")
             except UnicodeDecodeError:
                 st.error("Encoding error: Ensure the file is UTF-8 encoded")
             except pd.errors.ParserError:
@@ -449,32 +1127,85 @@ def main():
                 st.error(f"An unexpected error occured: {e}")
 
 
-            # Find the levels in the first column
-            levels = df.iloc[:, 0]
-            levels['ITL_Level'] = df[df.columns[0]].apply(assign_itl_level)
-            levels['CA_Level'] = df[df.columns[0]].apply(assign_ca_level)
-            levels = pd.concat([levels['ITL_Level'], levels['CA_Level']]).drop_duplicates().tolist()
-            if 'TLB' in list(df[df.columns[0]]):
-                levels.append('National')
-            if '' in levels:
-                levels.remove('')
-            if len(levels) > 1:
+            boundary_layer = None
+            if boundary_options and not df.empty:
+                try:
+                    with st.spinner('Preparing boundaries...'):
+                        boundary_data = boundary_options[0].getvalue()
+                        boundary_key, boundary_layer = get_boundary_layer(boundaries.file_hash(boundary_data), *boundary_options[1:], boundary_data, boundary_options[0].name)
+                except ValueError as e:
+                    st.error(str(e))
+
+            if boundary_layer is not None:
+                # Regions come from the boundary file, so there are no levels to detect
+                df[df.columns[0]] = df[df.columns[0]].astype(str).str.strip()
+                matched = df[df.columns[0]].isin(boundary_layer[boundaries.CODE_COLUMN])
+                levels = []
                 st.session_state.levels = levels
-                level = levels[0]
-                st.session_state.level = levels[0]
-            st.session_state.index = 0
-            
-            # reset_insights()
-            if df.iloc[0, 0][:2] == 'TL' or len(df.iloc[0, 0]) == 9:
-                fig = True
-                mapname = df.columns[1:].tolist()
-            else:
+                st.session_state.index = 0
+                if matched.any():
+                    fig = True
+                    mapname = df.columns[1:].tolist()
+                    st.session_state.boundaries = (region_codes_key(df), boundary_key, boundary_layer)
+                    if not matched.all():
+                        st.warning(f"{(~matched).sum()} region codes aren't in the boundary file and are left off the map.")
+                else:
+                    fig = False
+                    mapname = []
+                    st.error("None of the region codes match the boundary file's code property.")
+            elif boundary_options:
                 fig = False
                 mapname = []
-                st.error("Region code not recognised.")
+            else:
+                st.session_state.boundaries = None
+                # Clean up and translate the region codes before working out their levels
+                df, code_report = codes.normalise_dataset(df, get_code_index(itlmapping, mcamapping))
+                show_code_report(code_report)
+                # Find the levels in the first column
+                levels = df.iloc[:, 0]
+                levels['ITL_Level'] = df[df.columns[0]].apply(assign_itl_level)
+                levels['CA_Level'] = df[df.columns[0]].apply(assign_ca_level)
+                levels = pd.concat([levels['ITL_Level'], levels['CA_Level']]).drop_duplicates().tolist()
+                if 'TLB' in list(df[df.columns[0]]):
+                    levels.append('National')
+                if '' in levels:
+                    levels.remove('')
+                if len(levels) > 1:
+                    st.session_state.levels = levels
+                    level = levels[0]
+                    st.session_state.level = levels[0]
+                st.session_state.index = 0
+            
+                # reset_insights()
+                if df.iloc[0, 0][:2] == 'TL' or len(df.iloc[0, 0]) == 9:
+                    fig = True
+                    mapname = df.columns[1:].tolist()
+                else:
+                    fig = False
+                    mapname = []
+                    st.error("Region code not recognised.")
                 
         else:
             st.error("No file uploaded yet.")
+    # Points (sites, firms, projects) drawn over the map, clustered on the server so the browser gets a bounded number of markers
+    overlay_options = None
+    with st.expander(label="Point overlay", expanded=False):
+        overlay_file = st.file_uploader("Upload points to overlay", type=["csv"], key='overlay_file')
+        if overlay_file:
+            try:
+                overlay_columns = pd.read_csv(overlay_file, nrows=0).columns.tolist()
+            except Exception:
+                overlay_columns = []
+            overlay_file.seek(0)
+            overlay_col1, overlay_col2, overlay_col3 = st.columns(3)
+            with overlay_col1:
+                overlay_crs = st.selectbox("Coordinates", options=list(points.POINT_CRS.keys()), key='overlay_crs')
+            with overlay_col2:
+                overlay_x = st.selectbox("Longitude/easting column", options=overlay_columns, key='overlay_x')
+            with overlay_col3:
+                overlay_y = st.selectbox("Latitude/northing column", options=overlay_columns, index=min(1, max(len(overlay_columns) - 1, 0)), key='overlay_y')
+            overlay_options = (overlay_file.file_id, overlay_x, overlay_y, points.POINT_CRS[overlay_crs])
+
     rerun = False
     # If there are maps to switch between then display the select box
     if mapname:
@@ -500,205 +1231,107 @@ def main():
     else:
         # Otherwise show empty select box
         st.sidebar.selectbox("Select map", options=mapname)
+    # New maps calculated from the existing columns (differences, ratios, per capita values...)
+    if mapname and not df.empty:
+        with st.sidebar.expander("Add a derived map"):
+            derived_name = st.text_input("Name", key='derived_name')
+            derived_expression = st.text_area("Expression", key='derived_expression', help="Refer to columns in backticks, e.g. `Exports` / `Imports` * 100. You can use + - * / ** % and the functions abs, sqrt, log, log10 and exp.")
+            if st.button("Add map", key='derived_add'):
+                if not derived_name:
+                    st.error("Give the new map a name.")
+                elif derived_name in df.columns:
+                    st.error("A map with this name already exists.")
+                else:
+                    try:
+                        derived_values = get_derived_values(derived_expression, dataset_fingerprint(df), df)
+                        df = df.assign(**{derived_name: derived_values})
+                        st.session_state.df = df
+                        st.session_state.mapname = list(df.columns[1:])
+                        st.session_state.index = len(df.columns) - 2
+                        st.rerun()
+                    except ValueError as e:
+                        st.error(str(e))
     # If there is more than one geography level in the data then allow the user to select
     if len(levels) > 1:
         level = st.sidebar.selectbox("Select geography level", options=levels, index=levels.index(level), on_change=reset_insights)
-        if 'ITL' == level[:3]:
-            level_to_length = {'ITL1': 3, 'ITL2': 4, 'ITL3': 5}
-            st.session_state.df = df
-            df = df.loc[(df[df.columns[0]].str.len() == level_to_length[level]) & (df[df.columns[0]] != 'TLB')].copy()
-        elif level == 'National':
-            st.session_state.df = df
-            df = df[df[df.columns[0]].isin(['TLB', 'TLL', 'TLM', 'TLN'])]
-        else:
-            st.session_state.df = df
-            if level == 'MCA':
-                df = df.loc[df[df.columns[0]].str[:3].isin(['E47', 'E61'])].copy()
-            else:
-                df = df.loc[df[df.columns[0]].str.len() == 9].copy()
+        st.session_state.df = df
+        df = filter_level(df, level)
     else:
         st.session_state.df = df
         st.session_state.levels = []
-    # Sidebar updates after upload
-    st.sidebar.markdown("---")  # This creates a basic horizontal line (divider)
-    unit_options = ['None', '%', '£', '$', '€']
-    if 'unit' in query_params:
-        if query_params['unit'] in unit_options:
-            map_units = unit_options.index(query_params['unit'])
-        else:
-            map_units = 0
-    else:
-        map_units = 0
-    unit = st.sidebar.selectbox("Select units", options=unit_options, index=map_units)
+    # Grid view to compare several maps side by side
+    grid_view = st.sidebar.toggle(label='Compare maps in a grid', value=False, disabled=len(mapname) < 2)
+    grid_columns = []
+    shared_scale = True
+    if grid_view and len(mapname) > 1:
+        grid_columns = st.sidebar.multiselect('Maps to compare', options=mapname, default=mapname[:4], max_selections=9)
+        shared_scale = st.sidebar.toggle(label='Use one colour scale for all maps', value=True)
+    shared_style = {}
+    if st.session_state.get('shared_style') and not st.session_state.df.empty and st.session_state.shared_style[0] == region_codes_key(st.session_state.df):
+        shared_style = st.session_state.shared_style[1]
+    # Uploaded boundaries are used while the dataset has the regions they were uploaded with
+    boundary = (None, None)
+    if st.session_state.get('boundaries') and not st.session_state.df.empty and st.session_state.boundaries[0] == region_codes_key(st.session_state.df):
+        boundary = st.session_state.boundaries[1:]
+    # Drill down through the ITL levels: clicking a region shows only its child regions, one level down. The regions
+    # clicked are kept while the dataset's regions and the chosen level stay the same
+    drill_path = []
+    clickable = False
+    if fig and not grid_columns and level in drilldown.CHILD_LEVELS and drilldown.CHILD_LEVELS[level] in levels:
+        hierarchy = get_itl_hierarchy(itlmapping)
+        drill_key = (level, region_codes_key(st.session_state.df))
+        if st.session_state.get('drill', (None, []))[0] != drill_key:
+            st.session_state.drill = (drill_key, [])
+        drill_path = st.session_state.drill[1]
+        shown_level = drilldown.drilled_level(level, drill_path)
+        if drill_path:
+            children = drilldown.filter_children(filter_level(st.session_state.df, shown_level), hierarchy, shown_level, drill_path[-1])
+            if children.empty:
+                # No data for the region's children, go back to the whole level
+                drill_path = []
+                shown_level = level
+                st.session_state.drill = (drill_key, drill_path)
+            else:
+                df = children
+        clickable = shown_level in drilldown.CHILD_LEVELS and drilldown.CHILD_LEVELS[shown_level] in levels
 
-    dp_options = list(range(6))
-    if 'dp' in query_params:
-        try:
-            map_dp = min(max(float(query_params['dp']), 0), 5)
-        except:
-            map_dp = 0
-    else:
-        map_dp = 0
-    dp = st.sidebar.select_slider("Select decimal places", options=dp_options, value=map_dp)
-    show_missing_values = st.sidebar.toggle(label='Hide the rest of the UK', value=False)
-    if 'size' in query_params:
-        try:
-            map_size = min(max(float(query_params['size']), 0.25), 2)
-        except:
-            map_size = 1
-    else:
-        map_size = 1
-    map_height = st.sidebar.slider("Adjust map size", min_value=0.25, max_value=float(2), value=float(map_size), step=0.01) * 550
-    st.sidebar.markdown("---")  # This creates a basic horizontal line (divider)
-    # Colour change options
-    discrete_colours = st.sidebar.toggle(label='Use discrete colouring')
-    num_colours = st.sidebar.slider("Number of Colours", min_value=2, max_value=6, value=5)
+        def drill_down():
+            region = drilldown.clicked_region(st.session_state[drill_chart_key])
+            child_level = drilldown.CHILD_LEVELS[shown_level]
+            if region and not drilldown.filter_children(filter_level(st.session_state.df, child_level), hierarchy, child_level, region).empty:
+                st.session_state.drill = (drill_key, drill_path + [region])
 
-    if not df.empty and 'index' in st.session_state and mapname:
-        df[mapname[st.session_state.index]] = (df[mapname[st.session_state.index]].astype(str).str.replace(r"[^\d.-]", "", regex=True))
-        df[mapname[st.session_state.index]] = pd.to_numeric(df[mapname[st.session_state.index]], errors="coerce")
+        def drill_up():
+            st.session_state.drill = (drill_key, drill_path[:-1])
 
-    # Colour pickers
-    colours = []
-    # Create two columns in the sidebar using container
-    with st.sidebar.container():
-        if discrete_colours:
-            # Create evenly spaced thresholds
-            if not df.empty and mapname:
-                min_val = df[mapname[st.session_state.index]].min()
-                max_val = df[mapname[st.session_state.index]].max()
-                thresholds = np.linspace(min_val, float(max_val), num_colours+1)
-            else:
-                thresholds = np.linspace(0, 100, num_colours+1)
-                min_val = 0
-                max_val = 100
-            if any(np.isnan(x) for x in thresholds):
-                thresholds = np.linspace(0, 100, num_colours+1)
-                min_val = 0
-                max_val = 100
-            thresholds = [round(x, 5) for x in thresholds]
-            colour_column1, colour_column2, colour_column3, colour_column4, colour_column5 = st.columns(5)  # Create two columns
-            step = float(10**-(dp+1))
-            for i in range(1, num_colours + 1):
-                if i > 3:
-                    if i == 4:
-                        if num_colours != i:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#47be6d", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        else:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#47be6d", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                    elif i == 5:
-                        if num_colours != i:
-                            with colour_column1:
-                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
-                            with colour_column2:
-                                colour = st.color_picker(f"-", "#f4e625", label_visibility='hidden')
-                            with colour_column3:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        else:
-                            with colour_column1:
-                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
-                            with colour_column2:
-                                colour = st.color_picker(f"-", "#f4e625", label_visibility='hidden')
-                            with colour_column3:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                    else:
-                        if num_colours != i:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#ffffff", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        else:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#ffffff", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                else:
-                    if i == 1:
-                        with colour_column1:
-                            thresholds[i-1] = st.number_input('<', max_value=float(thresholds[i] - step/10), value=float(thresholds[i-1]), step=step, key=f'-input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        with colour_column2:
-                            colour = st.color_picker(f"-", "#440255", label_visibility='hidden')
-                        with colour_column3:
-                            thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                    elif i == 2:
-                        if num_colours != i:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#39538b", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        else:
-                            with colour_column4:
-                                colour = st.color_picker(f"-", "#39538b", label_visibility='hidden')
-                            with colour_column5:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                    elif i == 3:
-                        if num_colours != i:
-                            with colour_column1:
-                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
-                            with colour_column2:
-                                colour = st.color_picker(f"-", "#26828e", label_visibility='hidden')
-                            with colour_column3:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), float(thresholds[i+1]  - step/10), float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                        else:
-                            with colour_column1:
-                                st.text_input('-', f'{float(thresholds[i-1] + step/10):.{dp}f}', label_visibility='hidden', disabled=True, key=f'text_input_{i}')
-                            with colour_column2:
-                                colour = st.color_picker(f"-", "#26828e", label_visibility='hidden')
-                            with colour_column3:
-                                thresholds[i] = st.number_input('<', float(thresholds[i-1] + step/10), value=float(thresholds[i]), step=step, key=f'+input{i}', label_visibility="hidden", format=f'%.{dp}f')
-                colours.append(colour)
-                # print(float(thresholds[i]))
-            custom_colour_scale = colours
-        else:
-            thresholds=[]
-            colour_column1, colour_column2 = st.columns(2)  # Create two columns
-            for i in range(num_colours):
-                if i > 2:
-                    with colour_column2:  # Use the second column for colours after index 2
-                        if i == 3:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#47be6d")
-                        elif i == 4:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#f4e625")
-                        else:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#ffffff")
-                        colours.append(colour)
-                else:
-                    with colour_column1:  # Use the first column for the first 3 colours
-                        if i == 0:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#440255")
-                        elif i == 1:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#39538b")
-                        elif i == 2:
-                            colour = st.color_picker(f"Pick Colour {i+1}", "#26828e")
-                        colours.append(colour)
-
-            custom_colour_scale = generate_colour_scale(colours)
+        drill_chart_key = 'drill_map_' + '_'.join(drill_path)
+        if drill_path:
+            region_names = get_region_names(itlmapping, mcamapping)
+            with breadcrumb.container():
+                crumb_col1, crumb_col2 = st.columns([4, 1])
+                with crumb_col1:
+                    st.markdown(' › '.join([f'All {level} regions'] + [region_names.get(code, code) for code in drill_path]))
+                with crumb_col2:
+                    st.button('Back up a level', on_click=drill_up, use_container_width=True)
+    # Sidebar updates after upload
     st.sidebar.markdown("---")  # This creates a basic horizontal line (divider)
     if rerun:
         st.rerun()
-
-    # Labeling options
-    if fig:
-        # Save session state variables and load figure
-        with figure_loading.container():
-            with st.spinner('Loading map...'):
-                st.session_state.fig, st.session_state.mapname = get_figures(df, mcamapping, la_shapes_df, itlmapping, itl3_shapes_df, custom_colour_scale, show_missing_values, unit, dp, thresholds, map_height, st.session_state.index)
-                figure.plotly_chart(st.session_state.fig, use_container_width=True,
-                    config = {
-                        'toImageButtonOptions': {
-                            'filename': f"TPI_UK_Colour_Map_{st.session_state.mapname[st.session_state.index].replace(' ','_')}",
-                            'scale': 2
-                        }
-                    }
-                )
-            map_index = st.session_state.index
-            st.session_state.index = index
+    map_index = st.session_state.index if mapname else 0
+    if fig and not grid_columns:
+        st.session_state.index = index
+    with st.sidebar:
+        show_map(df, mapname, map_index, fig, levels, level, grid_columns, shared_scale, query_params, overlay_options, overlay_file, figure, figure_loading, summary, drill_path[-1] if drill_path else None, clickable, boundary, shared_style)
+    # Maps that can be clicked are drawn here rather than in show_map (see there)
+    if clickable and st.session_state.fig:
+        figure.plotly_chart(st.session_state.fig, use_container_width=True, key=drill_chart_key, on_select=drill_down, selection_mode='points',
+            config = {
+                'toImageButtonOptions': {
+                    'filename': f"TPI_UK_Colour_Map_{st.session_state.mapname[map_index].replace(' ','_')}",
+                    'scale': 2
+                }
+            }
+        )
     
     if 'preset' in query_params.keys() and not dvo:
         if query_params['preset'] == '2022_la_prod':
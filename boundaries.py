@@ -0,0 +1,159 @@
+import io
+import os
+import time
+import zipfile
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+'''
+User supplied boundaries (wards, constituencies, health boards...) from an uploaded GeoJSON or zipped shapefile.
+
+The file is read in batches, keeping only the code and name properties, and each batch is reprojected to EPSG:4326
+and has its geometries repaired. Features sharing a code are merged, then the whole layer is simplified (keeping
+shared borders shared) until it is small enough to draw. The result has the same columns as the built-in map layers
+(code, region, geometry), so it can be passed to make_choropleths like them.
+
+Every stage is bounded: the upload's size, the number of features and vertices read and the total time taken, and
+only MAX_CONCURRENT files are prepared at once, so a large upload gets an error rather than stalling other users.
+'''
+
+# Column the region codes are kept in, used as the layer's geo level
+CODE_COLUMN = 'code'
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MAX_UNZIPPED_BYTES = 200 * 1024 * 1024
+MAX_FEATURES = 20000
+MAX_INPUT_VERTICES = 5_000_000
+# Simplify until the layer has at most this many vertices, which keeps the figure a few MB
+TARGET_VERTICES = 250_000
+TIME_LIMIT = 60
+MAX_CONCURRENT = 1
+BATCH_SIZE = 1000
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+_preparing = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# A zipped shapefile with only its first shapefile's parts, at the top level where GDAL looks for them. Checks the
+# unzipped size first, so a small zip can't expand into something huge
+def flatten_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        if sum(info.file_size for info in archive.infolist()) > MAX_UNZIPPED_BYTES:
+            raise ValueError(f"The zip file is over {MAX_UNZIPPED_BYTES // 1024 ** 2}MB unzipped")
+        shapefiles = [name for name in archive.namelist() if name.lower().endswith('.shp') and not os.path.basename(name).startswith('.')]
+        if not shapefiles:
+            raise ValueError("The zip file doesn't contain a shapefile (.shp)")
+        stem = shapefiles[0][:-4]
+        flat = io.BytesIO()
+        with zipfile.ZipFile(flat, 'w') as out:
+            for name in archive.namelist():
+                extension = name[len(stem):].lower()
+                if name.startswith(stem) and extension in SHAPEFILE_PARTS:
+                    out.writestr('boundaries' + extension, archive.read(name))
+    return flat.getvalue()
+
+# File contents GDAL can open, after checking the size
+def open_source(data, filename):
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise ValueError(f"Boundary files can be at most {MAX_UPLOAD_BYTES // 1024 ** 2}MB")
+    if filename.lower().endswith('.zip'):
+        try:
+            data = flatten_zip(data)
+        except zipfile.BadZipFile:
+            raise ValueError("The zip file could not be opened, it may be damaged")
+    return io.BytesIO(data)
+
+# Property names of the features, to choose the code and name from
+def read_fields(data, filename):
+    try:
+        info = pyogrio.read_info(open_source(data, filename))
+    except pyogrio.errors.DataSourceError:
+        raise ValueError("The boundary file could not be read, upload a GeoJSON or a zipped shapefile")
+    return list(info['fields'])
+
+# Polygons only: invalid geometries are repaired, and any points or lines repair (or the file) left are dropped
+def repair_polygons(geometries):
+    geometries = shapely.make_valid(geometries)
+    types = shapely.get_type_id(geometries)
+    for i in np.flatnonzero(types == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = shapely.get_parts(geometries[i])
+        polygons = parts[np.isin(shapely.get_type_id(parts), [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])]
+        geometries[i] = shapely.union_all(polygons) if len(polygons) > 0 else None
+    types = shapely.get_type_id(geometries)
+    geometries[~np.isin(types, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])] = None
+    return geometries
+
+# Simplify a layer's geometries until they have at most TARGET_VERTICES vertices, doubling the tolerance each time.
+# Coverage simplification keeps borders between neighbours identical; it needs the regions not to overlap, otherwise
+# each region is simplified on its own
+def simplify_layer(geometries, deadline):
+    if shapely.get_num_coordinates(geometries).sum() <= TARGET_VERTICES:
+        return geometries
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    tolerance = max(maxx - minx, maxy - miny) * 1e-5
+    coverage = hasattr(shapely, 'coverage_simplify') and bool(shapely.coverage_is_valid(geometries))
+    while True:
+        if coverage:
+            simplified = shapely.coverage_simplify(geometries, tolerance)
+        else:
+            simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+        if shapely.get_num_coordinates(simplified).sum() <= TARGET_VERTICES:
+            return simplified
+        if time.monotonic() > deadline:
+            raise ValueError(f"The boundaries took longer than {TIME_LIMIT}s to prepare, try a smaller or simplified file")
+        tolerance *= 2
+
+# Run an uploaded boundary file through the whole pipeline. Raises ValueError with a message for the user
+def prepare_boundaries(data, filename, code_property, name_property=None):
+    if not _preparing.acquire(timeout=TIME_LIMIT):
+        raise ValueError("The server is busy preparing other boundary files, try again in a moment")
+    try:
+        return _prepare_boundaries(data, filename, code_property, name_property)
+    finally:
+        _preparing.release()
+
+def _prepare_boundaries(data, filename, code_property, name_property):
+    deadline = time.monotonic() + TIME_LIMIT
+    columns = [code_property] + ([name_property] if name_property and name_property != code_property else [])
+    batches = []
+    features = vertices = 0
+    try:
+        with pyogrio.open_arrow(open_source(data, filename), columns=columns, batch_size=BATCH_SIZE, use_pyarrow=True) as (meta, reader):
+            crs = meta['crs'] or 'EPSG:4326'  # GeoJSON without a crs member is WGS84 by definition
+            geometry_name = meta['geometry_name'] or 'wkb_geometry'
+            for batch in reader:
+                features += batch.num_rows
+                if features > MAX_FEATURES:
+                    raise ValueError(f"Boundary files can have at most {MAX_FEATURES} features")
+                geometries = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+                vertices += shapely.get_num_coordinates(geometries).sum()
+                if vertices > MAX_INPUT_VERTICES:
+                    raise ValueError(f"Boundary files can have at most {MAX_INPUT_VERTICES:,} vertices, simplify the file first")
+                geometries = gpd.GeoSeries(geometries, crs=crs).to_crs('EPSG:4326').to_numpy()
+                batches.append(pd.DataFrame({
+                    CODE_COLUMN: batch.column(code_property).to_pandas().astype(str).str.strip(),
+                    'region': batch.column(columns[-1]).to_pandas().astype(str).str.strip(),
+                    'geometry': repair_polygons(geometries)
+                }))
+                if time.monotonic() > deadline:
+                    raise ValueError(f"The boundaries took longer than {TIME_LIMIT}s to prepare, try a smaller or simplified file")
+    except pyogrio.errors.DataSourceError:
+        raise ValueError("The boundary file could not be read, upload a GeoJSON or a zipped shapefile")
+    if not batches:
+        raise ValueError("The boundary file has no features")
+
+    layer = pd.concat(batches, ignore_index=True)
+    layer = layer[layer['geometry'].notna() & (layer[CODE_COLUMN] != '')]
+    if layer.empty:
+        raise ValueError("The boundary file has no polygons with a code")
+    # Features sharing a code (e.g. the islands of one region stored separately) become one region
+    layer = gpd.GeoDataFrame(layer, geometry='geometry', crs='EPSG:4326').dissolve(by=CODE_COLUMN, aggfunc='first', as_index=False)
+    layer['geometry'] = simplify_layer(layer.geometry.to_numpy(), deadline)
+    layer = layer[~layer.geometry.is_empty]
+    return layer[[CODE_COLUMN, 'region', 'geometry']].reset_index(drop=True)
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import shapely
+from functools import lru_cache
+
+'''
+Hex map (tile cartogram) layouts: every region gets one equally sized hexagon, placed close to where it is on the map.
+
+Layouts are built from the boundary files once and stored in src/hex_layouts.csv, keyed by level and region code, so
+the app only reads a small table. The ITL2 and ITL3 maps hold both the 2021 and the 2025 regions, which overlap, so
+those levels get one layout per vintage (itl3_2021, itl3_2025) and a dataset is drawn on the vintage its codes match.
+Rebuild them after changing the boundary or mapping files with:
+python cartogram.py
+'''
+
+HEX_LAYOUT_FILE = 'src/hex_layouts.csv'
+# Mapping file listing each vintage's ITL codes, oldest first
+ITL_VINTAGES = {'2021': 'src/itlmapping.csv', '2025': 'src/la-itlmapping.csv'}
+VINTAGE_LEVELS = ['itl2', 'itl3']
+
+# Hexagons are pointy topped, with odd rows shifted half a cell right. In units of the hexagon's circumradius,
+# centres are sqrt(3) apart along a row and 1.5 apart between rows
+def hex_centres(cols, rows):
+    cols, rows = np.asarray(cols), np.asarray(rows)
+    return np.sqrt(3) * (cols + 0.5 * (rows % 2)), 1.5 * rows
+
+# Codes of a level in one ITL vintage
+@lru_cache(maxsize=None)
+def get_vintage_codes(geo_level, vintage):
+    return frozenset(pd.read_csv(ITL_VINTAGES[vintage], encoding='utf-8-sig')[geo_level].dropna())
+
+# The vintage whose codes most of the data's codes belong to (the latest on a tie), or None for levels with one layout
+def match_vintage(geo_level, codes):
+    if geo_level not in VINTAGE_LEVELS:
+        return None
+    codes = set(codes)
+    return max(reversed(list(ITL_VINTAGES)), key=lambda vintage: len(codes & get_vintage_codes(geo_level, vintage)))
+
+# Layout for a map level, indexed by region code, with the hexagon centres. nat is the ITL1 map with England merged and
+# vintage picks the ITL2/ITL3 layout of one set of boundaries (see match_vintage)
+@lru_cache(maxsize=None)
+def get_hex_layout(geo_level, nat=False, vintage=None):
+    layouts = pd.read_csv(HEX_LAYOUT_FILE)
+    key = f'{geo_level}_nat' if nat else f'{geo_level}_{vintage}' if vintage else geo_level
+    layout = layouts[layouts['level'] == key].set_index('code')
+    layout['x'], layout['y'] = hex_centres(layout['col'], layout['row'])
+    return layout[['region', 'col', 'row', 'x', 'y']]
+
+# Stretch one axis so crowded areas are spread out and sparse ones drawn in: coordinates move part of the way towards
+# the evenly spaced ranks of the regions' centres. The map is monotone, so regions keep their order and don't overlap
+def make_even_out(centres, low, high, strength):
+    knots = np.concatenate([[low], np.sort(centres), [high]])
+    scaled = (knots - low) / max(high - low, 1e-9)
+    ranks = np.concatenate([[0], np.arange(len(centres)) / max(len(centres) - 1, 1), [1]])
+    targets = (1 - strength) * scaled + strength * ranks
+    return lambda values: np.interp(values, knots, targets)
+
+# Place regions on a hex grid with one cell per region. The regions are evened out first, so dense cities and sparse
+# rural areas both end up as compact groups of cells, and the grid spacing is chosen so the hexagons cover the same
+# area as the evened out regions. Each region is given the free cell nearest it (regions in crowded areas first),
+# then pairs of regions swap cells and regions move to free cells while that reduces the total squared displacement
+def build_hex_layout(shapes, code_col, name_col, strength=0.5, max_rounds=2000):
+    shapes = shapes.drop_duplicates(code_col).to_crs('EPSG:27700')  # British National Grid, in metres
+    geometries = shapes.geometry.values
+    points = shapes.geometry.representative_point()
+    minx, miny, maxx, maxy = shapes.total_bounds
+    strength *= min(len(shapes) / 100, 1)  # With only a few regions, ranks say little about where they are
+    even_x = make_even_out(points.x.to_numpy(), minx, maxx, strength)
+    even_y = make_even_out(points.y.to_numpy(), miny, maxy, strength)
+    aspect = (maxx - minx) / max(maxy - miny, 1e-9)
+
+    def even_out(coords):
+        return np.column_stack([even_x(coords[:, 0]) * aspect, even_y(coords[:, 1])])
+
+    px, py = even_out(shapely.get_coordinates(points.values)).T
+    n = len(shapes)
+    area = shapely.area(shapely.transform(geometries, even_out)).sum()
+    spacing = np.sqrt(2 * area / (np.sqrt(3) * n))  # Distance between neighbouring centres
+    radius = spacing / np.sqrt(3)
+
+    # Every cell over the regions' extent plus a margin, and the squared distance from each region to each cell
+    col_range = np.arange(int(np.floor(px.min() / spacing)) - 3, int(np.ceil(px.max() / spacing)) + 4)
+    row_range = np.arange(int(np.floor(py.min() / (1.5 * radius))) - 3, int(np.ceil(py.max() / (1.5 * radius))) + 4)
+    cols, rows = [grid.ravel() for grid in np.meshgrid(col_range, row_range)]
+    cx, cy = hex_centres(cols, rows)
+    cost = (px[:, None] - cx[None, :] * radius) ** 2 + (py[:, None] - cy[None, :] * radius) ** 2
+
+    # Crowded regions (close to their neighbours) pick first, so they keep the cells nearest them
+    gaps = np.sqrt((px[:, None] - px[None, :]) ** 2 + (py[:, None] - py[None, :]) ** 2)
+    np.fill_diagonal(gaps, np.inf)
+    cell = np.full(n, -1)
+    taken = np.zeros(len(cols), dtype=bool)
+    for i in np.argsort(np.sort(gaps, axis=1)[:, :min(3, n - 1)].mean(axis=1)):
+        choice = np.argmin(np.where(taken, np.inf, cost[i]))
+        cell[i] = choice
+        taken[choice] = True
+
+    for _ in range(max_rounds):
+        current = cost[np.arange(n), cell]
+        # Best swap between two regions
+        swap = cost[:, cell] + cost[:, cell].T - current[:, None] - current[None, :]
+        i, j = np.unravel_index(np.argmin(swap), swap.shape)
+        # Best move of a region to a free cell
+        move = np.where(taken[None, :], np.inf, cost) - current[:, None]
+        k, free = np.unravel_index(np.argmin(move), move.shape)
+        if min(swap[i, j], move[k, free]) >= -1e-6:
+            break
+        if swap[i, j] <= move[k, free]:
+            cell[i], cell[j] = cell[j], cell[i]
+        else:
+            taken[cell[k]] = False
+            cell[k] = free
+            taken[free] = True
+
+    # Shift so the layout starts at column and row 0 (an even row shift keeps odd rows offset the same way)
+    row_shift = rows[cell].min() - rows[cell].min() % 2
+    return pd.DataFrame({
+        'code': shapes[code_col].to_numpy(),
+        'region': shapes[name_col].to_numpy(),
+        'col': cols[cell] - cols[cell].min(),
+        'row': rows[cell] - row_shift
+    })
+
+def main():
+    from Streamlit_Mapping import load_files, make_map_itl, make_map_authorities
+    mcamapping, la_shapes_df, itlmapping, itl3_shapes_df = load_files()
+    layouts = []
+    for level, nat in [('itl1', False), ('itl1', True), ('itl2', False), ('itl3', False), ('la', False), ('mca', False)]:
+        if level[:3] == 'itl':
+            map_df = make_map_itl(level, itlmapping, itl3_shapes_df, nat)
+        else:
+            map_df = make_map_authorities(level, mcamapping, la_shapes_df)
+        if level == 'mca':
+            map_df = map_df[map_df['region_type'] == 'mca']  # The non-MCA background isn't a region
+        if level in VINTAGE_LEVELS:
+            # Overlapping boundaries can't share a grid, so each vintage is laid out on its own
+            parts = [(f'{level}_{vintage}', map_df[map_df[level].isin(get_vintage_codes(level, vintage))]) for vintage in ITL_VINTAGES]
+        else:
+            parts = [(f'{level}_nat' if nat else level, map_df)]
+        for key, part in parts:
+            layout = build_hex_layout(part, level, 'region')
+            layout.insert(0, 'level', key)
+            layouts.append(layout)
+            print(f"{key}: {len(layout)} regions")
+    pd.concat(layouts, ignore_index=True).to_csv(HEX_LAYOUT_FILE, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import pandas as pd
+
+'''
+Clean up the region codes of uploaded data before they are matched to the map.
+
+Codes are cleaned in one vectorised pass over the distinct codes: byte order marks, zero width and non-breaking spaces
+and surrounding whitespace are removed and letters are upper cased. Legacy codes are then translated to current ones
+with an index built from the mapping files in src/: NUTS codes (UKC11) to the ITL codes that replaced them (TLC11),
+LAU1 codes (S30000003) to local authority codes (S12000005), and the districts abolished in 2023 to the unitary
+authority each merged into. Every change is reported, with codes that are still not recognised listed too. Codes of
+local authorities in the mapping files that have left the map without a successor listed here are reported as such.
+'''
+
+LA_ITL_MAPPING_FILE = 'src/la-itlmapping.csv'
+# Characters that come along with codes copied from spreadsheets and web pages
+HIDDEN_CHARACTERS = '[\ufeff\u200b\u200c\u200d\u2060\u00a0]'
+# Districts abolished in the April 2023 reorganisation -> the unitary authority each became part of
+LAD_SUCCESSORS = {
+    'E07000026': 'E06000063', 'E07000028': 'E06000063', 'E07000029': 'E06000063',  # Cumberland
+    'E07000027': 'E06000064', 'E07000030': 'E06000064', 'E07000031': 'E06000064',  # Westmorland and Furness
+    'E07000163': 'E06000065', 'E07000164': 'E06000065', 'E07000165': 'E06000065', 'E07000166': 'E06000065',
+    'E07000167': 'E06000065', 'E07000168': 'E06000065', 'E07000169': 'E06000065',  # North Yorkshire
+    'E07000187': 'E06000066', 'E07000188': 'E06000066', 'E07000189': 'E06000066', 'E07000246': 'E06000066'  # Somerset
+}
+
+# Translations (legacy code -> current code and the reason) and the codes the maps know, built once from the mapping files
+def build_code_index(itlmapping, mcamapping, la_itlmapping):
+    translations = []
+    for level in ['itl1', 'itl2', 'itl3']:
+        current = pd.Series(itlmapping[level].dropna().unique())
+        translations.append(pd.DataFrame({'legacy': 'UK' + current.str[2:], 'code': current, 'change': 'NUTS code replaced by ITL code'}))
+    lau = la_itlmapping[['LAU125CD', 'LAD24CD']].dropna().drop_duplicates()
+    lau = lau[(lau['LAU125CD'] != lau['LAD24CD']) & ~lau['LAU125CD'].duplicated(keep=False)]  # Only one to one translations
+    translations.append(pd.DataFrame({'legacy': lau['LAU125CD'], 'code': lau['LAD24CD'], 'change': 'LAU1 code replaced by local authority code'}))
+    translations.append(pd.DataFrame({'legacy': list(LAD_SUCCESSORS), 'code': list(LAD_SUCCESSORS.values()), 'change': 'Abolished LAD replaced by successor authority'}))
+    translations = pd.concat(translations, ignore_index=True).drop_duplicates('legacy').set_index('legacy')
+
+    known = pd.Index(pd.concat([itlmapping[level] for level in ['itl1', 'itl2', 'itl3']] + [mcamapping['la'], mcamapping['mca'], pd.Series(['TLB'])]).dropna().unique())
+    # Authorities in the mapping files but not on the current map, and with no successor to translate them to
+    retired = pd.Index(mcamapping.loc[~mcamapping['la'].isin(la_itlmapping['LAD24CD']), 'la'].dropna().unique()).difference(translations.index)
+    return {'translations': translations, 'known': known.difference(retired), 'retired': retired}
+
+# Cleaned and translated codes for a column of codes, with a report of every distinct code changed or not recognised:
+# the original, the code it became, what was done and the number of rows with it
+def normalise_codes(codes, code_index):
+    original = codes.astype('string').fillna('')
+    distinct = pd.Series(original.unique(), dtype='string')
+    without_hidden = distinct.str.replace(HIDDEN_CHARACTERS, '', regex=True)
+    stripped = without_hidden.str.strip()
+    cleaned = stripped.str.upper()
+    translations = code_index['translations']
+    legacy = cleaned.isin(translations.index)
+    current = cleaned.where(~legacy, cleaned.map(translations['code']))
+
+    changes = pd.DataFrame({
+        'Hidden characters removed': without_hidden != distinct,
+        'Spaces removed': stripped != without_hidden,
+        'Upper cased': cleaned != stripped
+    })
+    notes = changes.apply(lambda changed: changed.map({True: changed.name, False: ''}))
+    notes['legacy'] = cleaned.map(translations['change']).where(legacy, '')
+    notes['retired'] = current.isin(code_index['retired']).map({True: 'Abolished local authority with no successor, not on the map', False: ''})
+    # Several codes becoming one (e.g. districts merged into a unitary authority) leave rows sharing a code, of which the map shows the first
+    notes['merged'] = (current.duplicated(keep=False) & (current != '')).map({True: 'Shares its code with other rows, only the first is mapped', False: ''})
+    notes['unknown'] = (~current.isin(code_index['known']) & ~current.isin(code_index['retired']) & (current != '')).map({True: 'Not recognised', False: ''})
+    notes = notes.apply(lambda row: '; '.join(note for note in row if note), axis=1)
+
+    report = pd.DataFrame({'Original': distinct, 'Code': current, 'Change': notes})
+    report = report[report['Change'] != '']
+    report['Rows'] = report['Original'].map(original.value_counts()).astype(int)
+    return original.map(pd.Series(current.to_numpy(), index=distinct.to_numpy())), report.reset_index(drop=True)
+
+# A dataset with its first column (the region codes) normalised and any hidden characters taken out of its header
+def normalise_dataset(df, code_index):
+    codes, report = normalise_codes(df[df.columns[0]], code_index)
+    header = pd.Series([df.columns[0]]).str.replace(HIDDEN_CHARACTERS, '', regex=True).str.strip()[0]
+    df = df.rename(columns={df.columns[0]: header})
+    df[header] = codes.astype(object)
+    return df, report
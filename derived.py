@@ -0,0 +1,94 @@
+import ast
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from profiling import clean_metrics
+
+# Functions an expression may call (all supported by DataFrame.eval and numexpr)
+ALLOWED_FUNCTIONS = {'abs', 'sqrt', 'log', 'log10', 'exp'}
+
+# Syntax an expression may use: arithmetic on columns, numbers and the functions above
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Constant, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.UAdd, ast.USub
+)
+
+# Largest constant exponent allowed. DataFrame.eval folds constant powers with Python integers, so an unbounded one
+# (e.g. 9 ** 9 ** 8) would tie up the server working out a number with millions of digits
+MAX_EXPONENT = 100
+
+# Columns are referenced in backticks, as in DataFrame.eval, because their names contain spaces and brackets
+COLUMN_PATTERN = re.compile(r"`([^`]+)`")
+
+# Whether part of an expression refers to a column
+def uses_column(node):
+    return any(isinstance(child, ast.Name) and child.id not in ALLOWED_FUNCTIONS for child in ast.walk(node))
+
+# A plain number, possibly signed, and its value
+def number_value(node):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = number_value(node.operand)
+        return None if value is None else (-value if isinstance(node.op, ast.USub) else value)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    return None
+
+# Check an expression and rewrite it over placeholder names (c0, c1, ...), returning the rewritten expression and
+# the columns it uses. Raises ValueError with a message for the user if the expression isn't allowed.
+# Cached, so each distinct expression is parsed and validated once
+@lru_cache(maxsize=256)
+def compile_expression(expression, columns):
+    used = []
+
+    def placeholder(match):
+        column = match.group(1)
+        if column not in columns:
+            raise ValueError(f"Unknown column: {column}")
+        if column not in used:
+            used.append(column)
+        return f"c{used.index(column)}"
+
+    compiled = COLUMN_PATTERN.sub(placeholder, expression.strip())
+    if not compiled:
+        raise ValueError("Expression is empty")
+    try:
+        tree = ast.parse(compiled, mode='eval')
+    except SyntaxError:
+        raise ValueError("Expression could not be read, check the brackets and operators")
+
+    # Only the placeholders made for the columns above; a typed c1 is as unknown as any other bare name
+    placeholders = {f"c{i}" for i in range(len(used))}
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"Not allowed in an expression: {type(node).__name__}")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in ALLOWED_FUNCTIONS):
+            raise ValueError(f"Only these functions can be used: {', '.join(sorted(ALLOWED_FUNCTIONS))}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Only numbers can be used as constants")
+        if isinstance(node, ast.Name) and node.id not in ALLOWED_FUNCTIONS and node.id not in placeholders:
+            raise ValueError(f"Unknown name: {node.id} (put column names in backticks)")
+        # A power without a column in its exponent must raise to a small number, and without a column in its base
+        # too it must be of plain numbers, so no constant power can grow without bound
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow) and not uses_column(node.right):
+            exponent = number_value(node.right)
+            if exponent is None or abs(exponent) > MAX_EXPONENT:
+                raise ValueError(f"Powers must use a column or a number up to {MAX_EXPONENT} as the exponent")
+            if not uses_column(node.left) and number_value(node.left) is None:
+                raise ValueError("Powers of numbers can't be raised to a power again")
+    if not used:
+        raise ValueError("Expression must use at least one column")
+    return compiled, tuple(used)
+
+# Evaluate a compiled expression over the dataset's columns in one vectorised pass; non-finite results become missing.
+# Raises ValueError with a message for the user if pandas can't evaluate it
+def evaluate_expression(df, compiled, used):
+    metrics = clean_metrics(df[[df.columns[0]] + list(used)])
+    metrics.columns = [f"c{i}" for i in range(len(used))]
+    try:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = metrics.eval(compiled)
+    except Exception as e:
+        raise ValueError(f"Expression could not be evaluated: {e}")
+    result = pd.Series(result, index=metrics.index, dtype=float)
+    return result.replace([np.inf, -np.inf], np.nan)
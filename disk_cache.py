@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import pandas as pd
+import geopandas as gpd
+import plotly.graph_objects as go
+
+'''
+Shared on-disk cache for running several replicas of the app.
+
+Set MAP_CACHE_DIR to a directory on a volume mounted into every replica and prepared map layers and figures are
+stored there in SQLite, keyed by a hash of their inputs, so only the first replica to need something builds it.
+MAP_CACHE_MAX_MB caps the size of the cache; the least recently used entries are evicted past it.
+When MAP_CACHE_DIR isn't set the cache is disabled and the app only uses Streamlit's in-process caches.
+'''
+
+CACHE_DIR = os.environ.get('MAP_CACHE_DIR', '')
+MAX_BYTES = int(float(os.environ.get('MAP_CACHE_MAX_MB', 2048)) * 1024 * 1024)
+# Only record a read in last_used if the entry hasn't been touched for this long, to keep reads from becoming writes
+TOUCH_INTERVAL = 300
+# Check the total size every this many writes
+EVICT_EVERY = 20
+
+_local = threading.local()
+_writes = 0
+_writes_lock = threading.Lock()
+
+def enabled():
+    return bool(CACHE_DIR)
+
+# One connection per thread; WAL mode lets replicas read while another writes
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(CACHE_DIR, 'cache.sqlite'), timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, kind TEXT, value BLOB, size INTEGER, last_used REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        _local.conn = conn
+    return conn
+
+def _update_hash(digest, part):
+    if isinstance(part, gpd.GeoDataFrame):
+        _update_hash(digest, pd.DataFrame(part.drop(columns=part.geometry.name)))
+        digest.update(b''.join(part.geometry.to_wkb()))
+    elif isinstance(part, pd.DataFrame):
+        digest.update(repr(list(part.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+    elif isinstance(part, (list, tuple)):
+        digest.update(b'[')
+        for item in part:
+            _update_hash(digest, item)
+            digest.update(b',')
+        digest.update(b']')
+    elif isinstance(part, dict):
+        _update_hash(digest, sorted(part.items()))
+    else:
+        digest.update(repr(part).encode())
+
+# Content address for a mix of data frames, lists and plain values
+def make_key(kind, *parts):
+    digest = hashlib.sha256(kind.encode())
+    _update_hash(digest, parts)
+    return f'{kind}:{digest.hexdigest()}'
+
+# Fingerprint of a source file's contents, so cached layers are rebuilt if the boundary or mapping files change
+@lru_cache(maxsize=None)
+def file_key(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def get(key):
+    row = _connection().execute('SELECT value, last_used FROM entries WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[1] > TOUCH_INTERVAL:
+        _connection().execute('UPDATE entries SET last_used = ? WHERE key = ?', (now, key))
+    return zlib.decompress(row[0])
+
+def put(key, kind, value):
+    global _writes
+    compressed = zlib.compress(value, 1)
+    _connection().execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, kind, compressed, len(compressed), time.time()))
+    with _writes_lock:
+        _writes += 1
+        check = _writes % EVICT_EVERY == 0
+    if check:
+        evict()
+
+# Drop the least recently used entries until the cache is back under 90% of its size limit
+def evict():
+    conn = _connection()
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    while total > MAX_BYTES * 0.9:
+        oldest = conn.execute('SELECT key, size FROM entries ORDER BY last_used LIMIT 50').fetchall()
+        if not oldest:
+            break
+        conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in oldest])
+        total -= sum(size for _, size in oldest)
+
+def get_object(key):
+    value = get(key)
+    return None if value is None else pickle.loads(value)
+
+def put_object(key, kind, obj):
+    put(key, kind, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+# GeoJSON already read from (or written to) the cache, by key. Holding the objects also keeps their ids valid below
+_geojson = OrderedDict()
+_geojson_keys = OrderedDict()  # id of a GeoJSON dict -> (dict, key)
+_geojson_lock = threading.Lock()
+MAX_GEOJSON = 32
+
+def _remember_geojson(key, geojson):
+    with _geojson_lock:
+        _geojson[key] = geojson
+        _geojson_keys[id(geojson)] = (geojson, key)
+        while len(_geojson) > MAX_GEOJSON:
+            _geojson.popitem(last=False)
+        while len(_geojson_keys) > MAX_GEOJSON:
+            _geojson_keys.popitem(last=False)
+
+# Store a GeoJSON dict once by the hash of its contents and return its key
+def _put_geojson(geojson):
+    with _geojson_lock:
+        known = _geojson_keys.get(id(geojson))
+    if known is not None and known[0] is geojson:
+        return known[1]
+    value = json.dumps(geojson, separators=(',', ':')).encode()
+    key = f'geojson:{hashlib.sha256(value).hexdigest()}'
+    if _connection().execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is None:
+        put(key, 'geojson', value)
+    _remember_geojson(key, geojson)
+    return key
+
+def _get_geojson(key):
+    with _geojson_lock:
+        if key in _geojson:
+            _geojson.move_to_end(key)
+            return _geojson[key]
+    value = get(key)
+    if value is None:
+        return None
+    geojson = json.loads(value)
+    _remember_geojson(key, geojson)
+    return geojson
+
+# Store a figure as JSON with its traces' GeoJSON stored separately by content, so the figures for every column of
+# a layer share one copy of its geometry
+def put_figure(key, fig):
+    geojson_keys = []
+    detached = []
+    for trace in fig.data:
+        geojson = trace['geojson'] if 'geojson' in trace else None
+        if isinstance(geojson, dict):
+            geojson_keys.append(_put_geojson(geojson))
+            detached.append((trace, geojson))
+            trace.geojson = None
+        else:
+            geojson_keys.append(None)
+    try:
+        value = json.dumps({'figure': fig.to_json(), 'geojson': geojson_keys}).encode()
+    finally:
+        # Put the geometry back, setting the property directly avoids plotly copying it
+        for trace, geojson in detached:
+            trace.geojson = geojson
+    put(key, 'figure', value)
+
+def get_figure(key):
+    value = get(key)
+    if value is None:
+        return None
+    stored = json.loads(value)
+    fig = go.Figure(json.loads(stored['figure']))
+    for trace, geojson_key in zip(fig.data, stored['geojson']):
+        if geojson_key is not None:
+            geojson = _get_geojson(geojson_key)
+            if geojson is None:
+                return None  # Geometry was evicted, rebuild the figure
+            trace.geojson = geojson
+    return fig
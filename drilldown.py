@@ -0,0 +1,39 @@
+'''
+Drill down through the ITL hierarchy: clicking a region on an ITL1 map shows its ITL2 regions, and clicking one of
+those shows its ITL3 regions.
+
+The hierarchy (which regions sit inside which) is read from the ITL mapping file once and kept as parent -> children
+code lists, so each drill step only needs the child level's values and geometries for one parent, not the whole UK.
+'''
+
+# Level shown when drilling into a region of each level
+CHILD_LEVELS = {'ITL1': 'ITL2', 'ITL2': 'ITL3'}
+
+# Parent code -> child codes for each step down the hierarchy, keyed by the child level ('itl2', 'itl3')
+def build_hierarchy(itlmapping):
+    hierarchy = {}
+    for parent, child in [('itl1', 'itl2'), ('itl2', 'itl3')]:
+        pairs = itlmapping[[parent, child]].dropna().drop_duplicates()
+        hierarchy[child] = {code: children.tolist() for code, children in pairs.groupby(parent)[child]}
+    return hierarchy
+
+# Level shown after drilling through a path of regions from the top level
+def drilled_level(level, path):
+    for _ in path:
+        level = CHILD_LEVELS[level]
+    return level
+
+# Rows of the child level's data inside one parent region
+def filter_children(df, hierarchy, child_level, parent):
+    return df.loc[df[df.columns[0]].isin(hierarchy[child_level.lower()].get(parent, []))].copy()
+
+# Rows of a map layer inside one parent region, so a drill step only draws (and sends) that slice of the geometry
+def get_children_layer(map_df, hierarchy, geo_level, parent):
+    return map_df[map_df[geo_level].isin(hierarchy[geo_level].get(parent, []))].reset_index(drop=True)
+
+# Code of the region clicked on a map, from a plotly_chart selection; None if nothing with a code was clicked
+def clicked_region(selection):
+    for point in selection.get('selection', {}).get('points', []):
+        if point.get('location'):
+            return point['location']
+    return None
@@ -0,0 +1,242 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from unittest.mock import MagicMock
+import numpy as np
+import streamlit as st
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1 import app_test
+
+'''
+Load test for the map tool: runs many simulated user sessions at once against Streamlit_Mapping.py in this process,
+the way one container serves them, and reports rerun latency percentiles, throughput and memory growth.
+
+Sessions are driven headlessly with Streamlit's AppTest, so nothing is served and no network is needed.
+Each session repeats a scripted scenario (see SCENARIOS) of clicks and widget changes, timing every rerun.
+
+Example:
+python loadtest.py --sessions 8 --iterations 3 --scenario mixed --json results.json
+'''
+
+APP = 'Streamlit_Mapping.py'
+UPLOAD_LABEL = 'Upload a file'
+QUANTILES = [50, 90, 95, 99]
+
+# AppTest installs a mock Runtime before every run and removes it after, which breaks as soon as two sessions run
+# at once. Install one runtime for the whole test, as a real server has, and give AppTest a subclass to assign to
+def install_shared_runtime():
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage('/mock/media'))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    app_test.Runtime = type('SessionRuntime', (Runtime,), {})
+    config.set_option('global.appTest', True)
+
+# AppTest can't interact with file uploaders, so a session asks for an upload by putting a path in its session state
+# and the uploader returns that file as if the browser had sent it
+class SimulatedUpload(io.BytesIO):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        self.file_id = path
+        self.size = len(self.getvalue())
+
+def install_simulated_uploads():
+    file_uploader = st.file_uploader
+
+    def simulated_file_uploader(label, *args, **kwargs):
+        uploaded = file_uploader(label, *args, **kwargs)
+        path = st.session_state.get('loadtest_upload')
+        if uploaded is None and path and label == UPLOAD_LABEL:
+            return SimulatedUpload(path)
+        return uploaded
+
+    st.file_uploader = simulated_file_uploader
+
+def find_widget(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    return None
+
+# Steps of a scenario: each makes one user interaction on a session, which is then rerun and timed
+def open_preset(number):
+    def step(at):
+        at.button(key=f'Example_button{number}').click()
+    return f'open preset {number}', step
+
+def switch_column(at):
+    select = find_widget(at.selectbox, 'Select map')
+    if select is not None and len(select.options) > 1:
+        select.select(select.options[(select.options.index(select.value) + 1) % len(select.options)])
+
+def change_level(at):
+    select = find_widget(at.selectbox, 'Select geography level')
+    if select is not None and len(select.options) > 1:
+        select.select(select.options[(select.options.index(select.value) + 1) % len(select.options)])
+
+def toggle_discrete(at):
+    toggle = find_widget(at.toggle, 'Use discrete colouring')
+    if toggle is not None:
+        toggle.set_value(not toggle.value)
+
+def upload_file(path):
+    def step(at):
+        at.session_state['loadtest_upload'] = path
+        find_widget(at.button, 'Upload File').click()
+    return f'upload {os.path.basename(path)}', step
+
+SCENARIOS = {
+    'browse': [open_preset(4), ('switch column', switch_column), ('switch column', switch_column), ('toggle discrete', toggle_discrete), ('toggle discrete', toggle_discrete)],
+    'levels': [open_preset(9), ('change level', change_level), ('switch column', switch_column), ('change level', change_level)],
+    'upload': [upload_file('examples/ITL2_example.csv'), ('switch column', switch_column), ('toggle discrete', toggle_discrete), ('toggle discrete', toggle_discrete)],
+}
+SCENARIOS['mixed'] = None  # Each session picks one of the scenarios above
+
+# Resident memory of this process in MB, sampled in the background while sessions run
+def resident_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval=0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = [(0.0, resident_mb())]
+        self.stopped = threading.Event()
+        self.start_time = time.perf_counter()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.samples.append((time.perf_counter() - self.start_time, resident_mb()))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.samples.append((time.perf_counter() - self.start_time, resident_mb()))
+
+# One simulated user: load the page, then repeat their scenario, recording (session, step, seconds, failed) per rerun
+def run_session(session, scenario, iterations, think, timeout, results, lock):
+    rng = random.Random(session)
+    steps = SCENARIOS[scenario] if SCENARIOS[scenario] is not None else SCENARIOS[rng.choice(['browse', 'levels', 'upload'])]
+    at = AppTest.from_file(APP, default_timeout=timeout)
+
+    def timed_run(name):
+        start = time.perf_counter()
+        try:
+            at.run()
+            failed = len(at.exception) > 0
+        except Exception:
+            failed = True
+        with lock:
+            results.append((session, name, time.perf_counter() - start, failed))
+
+    timed_run('load page')
+    for _ in range(iterations):
+        for name, step in steps:
+            if think > 0:
+                time.sleep(rng.uniform(0, think))
+            try:
+                step(at)
+            except Exception:
+                with lock:
+                    results.append((session, name, 0.0, True))
+                continue
+            timed_run(name)
+
+def summarise(results, wall_time, memory):
+    latencies = np.array([seconds for _, _, seconds, failed in results if not failed])
+    summary = {
+        'reruns': len(results),
+        'errors': sum(failed for *_, failed in results),
+        'wall_time_s': wall_time,
+        'throughput_reruns_per_s': len(latencies) / wall_time if wall_time > 0 else 0.0,
+        'latency_s': {},
+        'steps': {},
+        'memory_mb': {
+            'start': memory[0][1],
+            'end': memory[-1][1],
+            'peak': max(mb for _, mb in memory),
+            'growth': memory[-1][1] - memory[0][1]
+        }
+    }
+    if len(latencies) > 0:
+        summary['latency_s'] = {f'p{q}': float(np.percentile(latencies, q)) for q in QUANTILES}
+        summary['latency_s']['mean'] = float(latencies.mean())
+        summary['latency_s']['max'] = float(latencies.max())
+    for name in dict.fromkeys(name for _, name, _, _ in results):
+        step_latencies = np.array([seconds for _, step, seconds, failed in results if step == name and not failed])
+        summary['steps'][name] = {
+            'count': int(sum(step == name for _, step, _, _ in results)),
+            'errors': int(sum(step == name and failed for _, step, _, failed in results)),
+            **({f'p{q}': float(np.percentile(step_latencies, q)) for q in [50, 95]} if len(step_latencies) > 0 else {})
+        }
+    return summary
+
+def print_summary(summary, sessions, scenario):
+    print(f"\n{sessions} sessions, scenario '{scenario}': {summary['reruns']} reruns in {summary['wall_time_s']:.1f}s, {summary['errors']} errors")
+    print(f"Throughput: {summary['throughput_reruns_per_s']:.2f} reruns/s")
+    if summary['latency_s']:
+        print('Rerun latency: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in summary['latency_s'].items()))
+    memory = summary['memory_mb']
+    print(f"Memory: {memory['start']:.0f}MB at start, {memory['peak']:.0f}MB peak, {memory['end']:.0f}MB at end ({memory['growth']:+.0f}MB)")
+    print(f"\n{'Step':<28}{'Count':>7}{'Errors':>8}{'p50 (s)':>10}{'p95 (s)':>10}")
+    for name, step in summary['steps'].items():
+        print(f"{name:<28}{step['count']:>7}{step['errors']:>8}{step.get('p50', float('nan')):>10.2f}{step.get('p95', float('nan')):>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the map tool with concurrent simulated sessions.')
+    parser.add_argument('--sessions', type=int, default=4, help='Number of simulated users running at once')
+    parser.add_argument('--iterations', type=int, default=2, help='Times each session repeats its scenario')
+    parser.add_argument('--scenario', choices=list(SCENARIOS), default='mixed')
+    parser.add_argument('--ramp', type=float, default=0, help='Seconds over which to start the sessions')
+    parser.add_argument('--think', type=float, default=0, help='Most seconds a user waits between interactions')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds before a single rerun counts as failed')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    # The app imports its modules (map, points, ...) from its own folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    install_shared_runtime()
+    install_simulated_uploads()
+
+    results, lock = [], threading.Lock()
+    memory = MemorySampler()
+    memory.start()
+    start = time.perf_counter()
+    threads = []
+    for session in range(args.sessions):
+        thread = threading.Thread(target=run_session, args=(session, args.scenario, args.iterations, args.think, args.timeout, results, lock))
+        thread.start()
+        threads.append(thread)
+        if args.ramp > 0 and session < args.sessions - 1:
+            time.sleep(args.ramp / (args.sessions - 1))
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+    memory.stop()
+
+    summary = summarise(results, wall_time, memory.samples)
+    print_summary(summary, args.sessions, args.scenario)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'summary': summary, 'memory_samples': memory.samples}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 import plotly.graph_objects as go
-from plotly.colors import sequential
+from plotly.colors import sequential, sample_colorscale
+from plotly.subplots import make_subplots
+import numpy as np
 import pandas as pd
-import geopandas as gpd
+import shapely
+from shapely.geometry import mapping
+from collections import OrderedDict
+import threading
 
 pd.set_option('future.no_silent_downcasting', True)  # Prevents deprecation warning from Pandas when using fillna
 
@@ -46,7 +51,8 @@ def wrap_title(title, max_length=100):
     
     return wrapped_title
 
-def make_choropleths(data, map_df, geo_level, colorscale=sequential.Viridis[::-1], show_missing_values=False, units='%', dp=2, thresholds=[], height=550, index=0):
+# Work out the number format and unit prefix for the hover data and colour scale
+def get_data_format(units, dp):
     if units == '%':
         data_format = f".{dp}%"  # Significant figures with '%' appended
         unit = ''
@@ -56,189 +62,487 @@ def make_choropleths(data, map_df, geo_level, colorscale=sequential.Viridis[::-1
     else:
         data_format = f".{dp}f"  # Units before the value
         unit = units
+    return data_format, unit
+
+# Strip any non-numeric characters (commas, units) from a column and convert it to numbers
+def clean_values(values):
+    values = values.astype(str).str.replace(r"[^\d.-]", "", regex=True)
+    return pd.to_numeric(values, errors="coerce")
+
+# Draw the key for discrete colouring as boxes with the threshold bounds either side
+def add_threshold_legend(fig, thresholds, colorscale, data_format, unit):
+    # Legend positioning
+    legend_x = 0.9
+    legend_y_start = 1
+    box_width = 0.03
+    spacing = 0.08
+
+    shapes = []
+    annotations = []
+
+    for i in range(len(thresholds) - 1):
+        y_position = legend_y_start - i * spacing
+
+        # Add colour box (rectangle)
+        shapes.append(dict(
+            type="rect",
+            xref="paper", yref="paper",
+            x0=legend_x - 0.015, x1=legend_x + box_width - 0.015,
+            y0=y_position - 0.04, y1=y_position,
+            fillcolor=colorscale[i][1],
+            line=dict(width=1, color="black")
+        ))
+
+        if i == 5:
+            y_position -= 0.013
+        if i == 0:
+            bounds_text = f"{unit}{thresholds[i]:{data_format}} ≤"
+        else:
+            bounds_text = f"{unit}{thresholds[i]:{data_format}} <"
+        # Left label (threshold1 <)
+        annotations.append(dict(
+            x=legend_x - 0.02,  # Left of the colour box
+            y=y_position,
+            xref="paper", yref="paper",
+            text=bounds_text,
+            showarrow=False,
+            align="right",
+            xanchor="right",
+            font=dict(size=12, color="black")
+        ))
+
+        # Right label (< threshold2)
+        annotations.append(dict(
+            x=legend_x + box_width - 0.01,  # Right of the colour box
+            y=y_position,
+            xref="paper", yref="paper",
+            text=f"≤ {unit}{thresholds[i + 1]:{data_format}}",
+            showarrow=False,
+            align="left",
+            xanchor="left",
+            font=dict(size=12, color="black")
+        ))
+
+    # Update layout
+    fig.update_layout(
+        shapes=shapes,
+        annotations=annotations,
+        margin=dict(r=200)  # Extra space for legend
+    )
+
+# Map layer indexes and grey background geometries already built. Sessions render in parallel threads so access is locked
+_layer_indexes = OrderedDict()
+_background_masks = OrderedDict()
+_cache_lock = threading.Lock()
+MAX_LAYER_INDEXES = 16
+MAX_BACKGROUND_MASKS = 128
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+def _cache_put(cache, key, value, max_entries):
+    with _cache_lock:
+        cache[key] = value
+        if len(cache) > max_entries:
+            cache.popitem(last=False)
+    return value
+
+# Add a trace and then attach its GeoJSON. Plotly deep-copies traces as they are added, which is slow for large geometry
+def add_geo_trace(fig, trace, geojson, **kwargs):
+    fig.add_trace(trace, **kwargs)
+    fig.data[-1].geojson = geojson
+    return fig
+
+# Key identifying a map layer: its level, region codes and names in row order and its coordinates. Uploaded boundary
+# layers all share a level and can share codes, so the names and geometry are part of the key too
+def get_layer_key(map_df, geo_level):
+    coordinates = shapely.get_coordinates(np.asarray(map_df.geometry.array))
+    return (geo_level, hash(tuple(map_df[geo_level])), hash(tuple(map_df['region'])), hash(coordinates.tobytes()))
+
+# Everything about a map layer that doesn't depend on the data: a code -> row position index, the region names,
+# which rows are drawn in the main trace and their GeoJSON. Built once per layer so renders never merge or copy geometry
+def get_layer_index(map_df, geo_level):
+    key = get_layer_key(map_df, geo_level)
+    layer_index = _cache_get(_layer_indexes, key)
+    if layer_index is not None:
+        return layer_index
+
+    if geo_level == 'mca':
+        drawn = (map_df['region_type'] == 'mca').to_numpy()  # The non-MCA background is only ever drawn in grey
+    else:
+        drawn = np.ones(len(map_df), dtype=bool)
+    layer_index = {
+        'key': key,
+        'codes': pd.Index(map_df[geo_level]),
+        'regions': map_df['region'].to_numpy(),
+        'drawn': drawn,
+        'geojson': map_df.loc[drawn, [geo_level, 'geometry']].__geo_interface__,
+        'bounds': map_df.total_bounds  # minx, miny, maxx, maxy over every region, including any grey background
+    }
+    return _cache_put(_layer_indexes, key, layer_index, MAX_LAYER_INDEXES)
+
+# Line a column's values up with the layer's rows in one vectorised take; regions without data get NaN
+def align_values(values, layer_index):
+    values = values[~values.index.duplicated()]
+    positions = values.index.get_indexer(layer_index['codes'])
+    aligned = values.to_numpy(dtype=float)[positions]
+    aligned[positions < 0] = np.nan
+    return aligned
+
+# GeoJSON for the regions missing data, built at most once per layer and distinct set of missing regions.
+# The missing set is keyed as a bitset over the layer's rows; dissolve merges the regions into one polygon
+def get_background_mask(map_df, geo_level, missing, dissolve=False):
+    key = get_layer_key(map_df, geo_level) + (dissolve, np.packbits(missing).tobytes())
+    mask = _cache_get(_background_masks, key)
+    if mask is not None:
+        return mask
+
+    if dissolve:
+        mask = {
+            'type': 'FeatureCollection',
+            'features': [{
+                'id': '0',
+                'type': 'Feature',
+                'properties': {geo_level: 'all_regions'},
+                'geometry': mapping(map_df.geometry[missing].union_all())
+            }]
+        }
+    else:
+        mask = map_df.loc[missing, [geo_level, 'geometry']].__geo_interface__
+    return _cache_put(_background_masks, key, mask, MAX_BACKGROUND_MASKS)
+
+# Values to colour regions by: the values themselves, or with discrete colouring the band each value falls in
+def get_colour_values(values, thresholds, dp, n_colours):
+    if len(thresholds) == 0:
+        return values
+    inc_thresholds = thresholds.copy()
+    inc_thresholds[0] -= (10 ** -dp)
+    inc_thresholds[-1] += (10 ** -dp)
+    categories = pd.cut(values, bins=inc_thresholds, labels=list(range(n_colours)))
+    z = categories.codes.astype(float)
+    z[z < 0] = np.nan  # Values outside the thresholds are treated as missing
+    return z
+
+# Centre and zoom that fit a bounding box into a web mercator map of the given size, so the WebGL map's view is
+# fixed server side rather than worked out from the features in the browser. Tiles are 512px wide at zoom 0
+def get_map_view(bounds, width, height, padding=0.9):
+    minx, miny, maxx, maxy = bounds
+    def mercator_y(lat):
+        return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    y_low, y_high = mercator_y(miny), mercator_y(maxy)
+    zoom_x = np.log2(width * padding * 360 / (max(maxx - minx, 1e-6) * 512))
+    zoom_y = np.log2(height * padding * 2 * np.pi / (max(y_high - y_low, 1e-6) * 512))
+    centre_lat = np.degrees(2 * np.arctan(np.exp((y_low + y_high) / 2)) - np.pi / 2)
+    return dict(lon=float((minx + maxx) / 2), lat=float(centre_lat)), float(min(zoom_x, zoom_y))
+
+# Renderers a map can be drawn with: 'geo' is SVG on a geo subplot, 'map' is WebGL (MapLibre) on a blank style with
+# no tile server, which stays smooth to pan and hover with many regions
+RENDERERS = {'geo': go.Choropleth, 'map': go.Choroplethmap}
+
+def make_choropleths(data, map_df, geo_level, colorscale=sequential.Viridis[::-1], show_missing_values=False, units='%', dp=2, thresholds=[], height=550, index=0, renderer='geo'):
+    choropleth = RENDERERS[renderer]
+    data_format, unit = get_data_format(units, dp)
 
     if len(thresholds) > 0:
         colorscale = [[i / (len(colorscale) - 1), color] for i, color in enumerate(colorscale)]
     
     column = data.columns[index]
-    temp = data[column]
-    temp = (temp.astype(str).str.replace(r"[^\d.-]", "", regex=True))
-    temp = pd.to_numeric(temp, errors="coerce")
+    layer_index = get_layer_index(map_df, geo_level)
+    values = align_values(clean_values(data[column]), layer_index)
 
     hovertemplate = '%{text}<br>' + column + f': {unit}'+'%{customdata[0]:' + data_format + '}<extra></extra>'
-    merged_df = map_df.merge(temp, on=geo_level, how='left')
 
+    z = get_colour_values(values, thresholds, dp, len(colorscale))
+    missing = np.isnan(z)
 
-    if len(thresholds) > 0:
-        inc_thresholds = thresholds.copy()
-        inc_thresholds[0] -= (10 ** -dp)
-        inc_thresholds[-1] += (10 ** -dp)
-        merged_df['category'] = pd.cut(
-            merged_df[column],
-            bins=inc_thresholds,
-            labels=list(range(len(colorscale)))
-        )
-        metric = 'category'
-    else:
-        metric = column
+    drawn = layer_index['drawn']
+    main_trace = choropleth(
+        featureidkey=f"properties.{geo_level}",  # Match with GeoJSON properties
+        locations=layer_index['codes'][drawn],  # Geographic identifiers in data
+        z=z[drawn],
+        text=layer_index['regions'][drawn], # Used to show the region name in the hovertemplate
+        colorscale=colorscale,
+        colorbar=dict(
+            tickformat=data_format, # Add percent sign to the colour scale
+            tickprefix = unit  # Adds the unit (£/$/€) to the colour scale
+        ),
+        showscale=len(thresholds) == 0,  # Show the colour scale
+        name='MCA Regions' if geo_level == 'mca' else None,
+        customdata=values[drawn, None],
+        hovertemplate=hovertemplate
+    )
 
     if geo_level == 'mca':
-        non_mca = merged_df[merged_df['region_type'] == 'non_mca'].copy()
-        mca = merged_df[merged_df['region_type'] == 'mca'].copy()
-        
         # Show MCA regions
-        fig = go.Figure(go.Choropleth(
-            geojson=mca.__geo_interface__,
-            featureidkey="id",  # Changed from properties.mca
-            locations=mca.index,  # Using index instead of mca column
-            z=mca[metric],
-            text=mca['region'], # Used to show the region name in the hovertemplate
-            colorscale=colorscale,
-            colorbar=dict(
-                tickformat=data_format, # Add percent sign to the colour scale
-                tickprefix = unit  # Adds the unit (£/$/€) to the colour scale
-            ),
-            showscale=len(thresholds) == 0,
-            name='MCA Regions',
-            customdata=merged_df[[column]],
-            hovertemplate=hovertemplate
-        ))
-
-        # If show_missing_values is True, add trace to show non-MCA regions in light grey
+        fig = go.Figure()
+        add_geo_trace(fig, main_trace, layer_index['geojson'])
+        # If show_missing_values is False, add trace to show non-MCA regions and MCA regions without data in light grey
         if not show_missing_values:
-            last_col = mca.columns[-1]
-            # Store missing data from MCA dataframe
-            missing_values_df = mca[mca[last_col].isna()]
-            # Merge missing data with non-mca data
-            non_mca = pd.concat([non_mca, missing_values_df]).reset_index(drop=True)
-            # Merge geometries of missing MCA regions and non-MCA regions
-            gdf = gpd.GeoDataFrame(non_mca, geometry="geometry", crs="EPSG:4326")
-            merged_geometry = gdf.geometry.unary_union
-            non_mca = gpd.GeoDataFrame({
-                "mca": ["all_regions"], 
-                "mcaname": ["All Regions"], 
-                "geometry": [merged_geometry],
-                last_col: [None]  # Add back column of NaN values for the choropleth
-            }, geometry="geometry", crs=gdf.crs)
-
-            fig.add_trace(go.Choropleth(
-                        geojson=non_mca.__geo_interface__,
-                        featureidkey="id",  # Changed from properties.mca
-                        locations=non_mca.index,  # Using index instead of mca column
-                        z=non_mca[metric].fillna(0),  # Fill NA with 0 for consistent coloring
+            add_geo_trace(fig, choropleth(
+                        featureidkey="id",
+                        locations=[0],  # The merged background is a single feature
+                        z=[0],
                         colorscale=[[0, '#e0e0e0'], [1, '#e0e0e0']],  # Light grey
                         showscale=False,
                         name='Non-MCA Regions',
                         hoverinfo='skip'
-                    ))
+                    ), get_background_mask(map_df, geo_level, missing, dissolve=True))
 
     else:  # If not MCA data
         fig = go.Figure()
-        if not show_missing_values:
-            last_col = merged_df.columns[-1]
-            missing_values_df = merged_df[merged_df[last_col].isna()]
-            fig.add_trace(go.Choropleth(
-                geojson=missing_values_df.__geo_interface__,
+        if not show_missing_values and missing.any():
+            add_geo_trace(fig, choropleth(
                 featureidkey=f"properties.{geo_level}",  # Match with GeoJSON properties
-                locations=missing_values_df[geo_level],  # Geographic identifiers in data
-                z=missing_values_df[metric].fillna(0),  # Fill NA with 0 for consistent coloring
+                locations=layer_index['codes'][missing],  # Geographic identifiers in data
+                z=np.zeros(missing.sum()),
                 colorscale=[[0, '#e0e0e0'], [1, '#e0e0e0']],  # Light grey
                 showscale=False,  # Show the colour scale
                 hoverinfo='skip'
-            ))
-        fig.add_trace(go.Choropleth(
-            geojson=merged_df.__geo_interface__,
-            featureidkey=f"properties.{geo_level}",  # Match with GeoJSON properties
-            locations=merged_df[geo_level],  # Geographic identifiers in data
-            z=merged_df[metric],  # Use precomputed indices for color
-            text=merged_df['region'], # Used to show the region name in the hovertemplate
-            colorscale=colorscale,  # Reverse the Viridis colour scale
-            colorbar=dict(
-                tickformat=data_format, # Add percent sign to the colour scale
-                tickprefix = unit
-            ),
-            showscale=len(thresholds) == 0,  # Show the colour scale
-            customdata=merged_df[[column]],
-            hovertemplate=hovertemplate
-        ))
-        
+            ), get_background_mask(map_df, geo_level, missing))
+        add_geo_trace(fig, main_trace, layer_index['geojson'])
+
+    if len(thresholds) > 0:
+        add_threshold_legend(fig, thresholds, colorscale, data_format, unit)
+
+    # Update layout
+    if renderer == 'map':
+        center, zoom = get_map_view(layer_index['bounds'], 800, height - 50)
+        fig.update_layout(map=dict(style='white-bg', center=center, zoom=zoom))
+    else:
+        fig.update_geos(
+            resolution=50,
+            projection_type= "mercator", #orthographic", #play with this, note that for some projection types, the height/width ratio is fixed    
+            framewidth = 1,
+            showframe = False, #shows border around subplots
+            coastlinecolor = '#d9d9d9',
+            fitbounds="locations",  
+            visible=False  # Hide default geographic features              
+            )
     
+    fig.update_layout(
+        title=wrap_title(column, max_length=100),
+        margin={"r":0,"t":50,"l":0,"b":0},  # Adjust margins
+        height = height,
+        width = 800
+    )
+    return fig
+
+# Outline of a pointy topped hexagon around each centre as an SVG path (plotly only takes absolute commands), in the
+# layout's units where the circumradius is 1
+def hexagon_paths(x, y, size=0.95):
+    angles = np.radians(np.arange(30, 390, 60))
+    vx = x[:, None] + size * np.cos(angles)[None, :]
+    vy = y[:, None] + size * np.sin(angles)[None, :]
+    return ['M' + 'L'.join(f'{px:.2f},{py:.2f}' for px, py in zip(xs, ys)) + 'Z' for xs, ys in zip(vx, vy)]
+
+# Hex map: one equal sized hexagon per region from a stored layout (see cartogram.py), joined to the data and coloured
+# the same way as make_choropleths. Hexagons are drawn as shapes so they scale with the figure, under an invisible
+# marker trace that carries the hover text and colour bar
+def make_cartogram(data, layout, geo_level, colorscale=sequential.Viridis[::-1], show_missing_values=False, units='%', dp=2, thresholds=[], height=550, index=0):
+    data_format, unit = get_data_format(units, dp)
+
     if len(thresholds) > 0:
-        # Legend positioning
-        legend_x = 0.9
-        legend_y_start = 1
-        box_width = 0.03
-        spacing = 0.08
-
-        shapes = []
-        annotations = []
-
-        for i in range(len(thresholds) - 1):
-            y_position = legend_y_start - i * spacing
-
-            # Add colour box (rectangle)
-            shapes.append(dict(
-                type="rect",
-                xref="paper", yref="paper",
-                x0=legend_x - 0.015, x1=legend_x + box_width - 0.015,
-                y0=y_position - 0.04, y1=y_position,
-                fillcolor=colorscale[i][1],
-                line=dict(width=1, color="black")
-            ))
+        colorscale = [[i / (len(colorscale) - 1), color] for i, color in enumerate(colorscale)]
 
-            if i == 5:
-                y_position -= 0.013
-            if i == 0:
-                bounds_text = f"{unit}{thresholds[i]:{data_format}} ≤"
-            else:
-                bounds_text = f"{unit}{thresholds[i]:{data_format}} <"
-            # Left label (threshold1 <)
-            annotations.append(dict(
-                x=legend_x - 0.02,  # Left of the colour box
-                y=y_position,
-                xref="paper", yref="paper",
-                text=bounds_text,
-                showarrow=False,
-                align="right",
-                xanchor="right",
-                font=dict(size=12, color="black")
-            ))
+    column = data.columns[index]
+    values = align_values(clean_values(data[column]), {'codes': layout.index})
+    z = get_colour_values(values, thresholds, dp, len(colorscale))
+    missing = np.isnan(z)
+    x, y = layout['x'].to_numpy(), layout['y'].to_numpy()
 
-            # Right label (< threshold2)
-            annotations.append(dict(
-                x=legend_x + box_width - 0.01,  # Right of the colour box
-                y=y_position,
-                xref="paper", yref="paper",
-                text=f"≤ {unit}{thresholds[i + 1]:{data_format}}",
-                showarrow=False,
-                align="left",
-                xanchor="left",
-                font=dict(size=12, color="black")
-            ))
+    if len(thresholds) > 0:
+        zmin, zmax = 0, len(colorscale) - 1
+    elif missing.all():
+        zmin, zmax = 0, 1
+    else:
+        zmin, zmax = float(np.nanmin(z)), float(np.nanmax(z))
+    fill = np.full(len(z), '#e0e0e0', dtype=object)  # Light grey
+    if not missing.all():
+        scaled = (z[~missing] - zmin) / (zmax - zmin) if zmax > zmin else np.zeros((~missing).sum())
+        fill[~missing] = sample_colorscale(colorscale, scaled)
+    drawn = ~missing if show_missing_values else np.ones(len(z), dtype=bool)
+
+    fig = go.Figure(go.Scatter(
+        x=x[~missing],
+        y=y[~missing],
+        mode='markers',
+        marker=dict(
+            color=z[~missing],
+            colorscale=colorscale,
+            cmin=zmin,
+            cmax=zmax,
+            opacity=0,  # The hexagon shapes show the colour, the markers are only there for hover
+            size=20,
+            showscale=len(thresholds) == 0,
+            colorbar=dict(
+                tickformat=data_format,
+                tickprefix=unit
+            )
+        ),
+        text=layout['region'].to_numpy()[~missing],
+        customdata=values[~missing, None],
+        hovertemplate='%{text}<br>' + column + f': {unit}'+'%{customdata[0]:' + data_format + '}<extra></extra>',
+        showlegend=False
+    ))
+
+    if len(thresholds) > 0:
+        add_threshold_legend(fig, thresholds, colorscale, data_format, unit)
+    # Everything else the hexagons share is set once as the shape defaults, so each shape is only a path and a colour
+    hexagons = [dict(type='path', path=path, fillcolor=colour) for path, colour in zip(hexagon_paths(x[drawn], y[drawn]), fill[drawn])]
+    fig.update_layout(
+        shapes=list(fig.layout.shapes) + hexagons,
+        template=dict(layout=dict(shapedefaults=dict(line=dict(width=1, color='white'), layer='below')))
+    )
+
+    fig.update_xaxes(visible=False, range=[x.min() - 1.5, x.max() + 1.5])
+    fig.update_yaxes(visible=False, range=[y.min() - 1.5, y.max() + 1.5], scaleanchor='x', scaleratio=1)
+    fig.update_layout(
+        title=wrap_title(column, max_length=100),
+        margin={"r":0,"t":50,"l":0,"b":0},  # Adjust margins
+        plot_bgcolor='rgba(0,0,0,0)',
+        height=height,
+        width=800
+    )
+    return fig
+
+# Colours of the hot and cold spot map, one per cluster label (not significant, high-high, low-low, high-low, low-high)
+CLUSTER_COLOURS = ['#d9d9d9', '#d7191c', '#2c7bb6', '#fdae61', '#abd9e9']
+
+# Hot and cold spot map: regions coloured by cluster code (an index into labels), drawn with make_choropleths on a
+# stepped colour scale with one band per cluster, then labelled by cluster on the colour bar and in the hover text
+def make_cluster_map(clusters, labels, map_df, geo_level, title, show_missing_values=False, height=550, renderer='geo'):
+    colorscale = []
+    for i, colour in enumerate(CLUSTER_COLOURS[:len(labels)]):
+        colorscale += [[i / len(labels), colour], [(i + 1) / len(labels), colour]]
+    fig = make_choropleths(pd.DataFrame({title: clusters}), map_df, geo_level, colorscale, show_missing_values, 'None', 0, [], height, 0, renderer)
+    names = np.array(list(labels) + [''], dtype=object)
+    for trace in fig.data:
+        if trace.customdata is not None:  # The main trace, the others are grey backgrounds
+            codes = np.nan_to_num(np.asarray(trace.customdata, dtype=float)[:, 0], nan=len(labels)).astype(int)
+            trace.update(
+                zmin=-0.5,
+                zmax=len(labels) - 0.5,
+                colorbar=dict(tickvals=list(range(len(labels))), ticktext=list(labels), tickformat='', tickprefix=''),
+                customdata=names[codes, None],
+                hovertemplate='%{text}<br>%{customdata[0]}<extra></extra>'
+            )
+    return fig
+
+# Small multiples: one subplot per selected column, every trace pointing at the same GeoJSON.
+# geojson can be a dict or a URL; a URL is fetched once by the browser and shared across subplots
+def make_choropleth_grid(data, map_df, geo_level, columns, colorscale=sequential.Viridis[::-1], show_missing_values=False, units='%', dp=2, thresholds=[], shared_scale=True, height=550, ncols=2, geojson=None):
+    data_format, unit = get_data_format(units, dp)
+    if geojson is None:
+        geojson = map_df.__geo_interface__
 
-        # Update layout
-        fig.update_layout(
-            shapes=shapes,
-            annotations=annotations,
-            margin=dict(r=200)  # Extra space for legend
+    if len(thresholds) > 0:
+        colorscale = [[i / (len(colorscale) - 1), color] for i, color in enumerate(colorscale)]
+
+    ncols = min(ncols, len(columns))
+    nrows = -(-len(columns) // ncols)  # Ceiling division
+    fig = make_subplots(
+        rows=nrows, cols=ncols,
+        specs=[[{'type': 'choropleth'}] * ncols for _ in range(nrows)],
+        subplot_titles=[wrap_title(column, max_length=40) for column in columns],
+        horizontal_spacing=0.02,
+        vertical_spacing=0.06
+    )
+
+    # Clean every selected column and line the values up with the map regions through the layer's positional index
+    layer_index = get_layer_index(map_df, geo_level)
+    codes, regions = layer_index['codes'], layer_index['regions']
+    values = {column: align_values(clean_values(data[column]), layer_index) for column in columns}
+    if len(thresholds) > 0:
+        zmin, zmax = 0, len(colorscale) - 1
+    elif np.isnan(list(values.values())).all():
+        zmin, zmax = 0, 1  # No data in any selected column, every panel is grey
+    else:
+        zmin, zmax = float(np.nanmin(list(values.values()))), float(np.nanmax(list(values.values())))
+
+    for i, column in enumerate(columns):
+        row, col = i // ncols + 1, i % ncols + 1
+        # Values outside the thresholds are missing too, as on the single map. The non-MCA background row never has
+        # data so it always falls in with the missing regions
+        z = get_colour_values(values[column], thresholds, dp, len(colorscale))
+        present = ~np.isnan(z)
+        missing = codes[~present]
+        z = z[present]
+
+        if not show_missing_values and len(missing) > 0:
+            add_geo_trace(fig, go.Choropleth(
+                featureidkey=f"properties.{geo_level}",
+                locations=missing,
+                z=np.zeros(len(missing)),
+                colorscale=[[0, '#e0e0e0'], [1, '#e0e0e0']],  # Light grey
+                showscale=False,
+                hoverinfo='skip'
+            ), geojson, row=row, col=col)
+
+        trace = go.Choropleth(
+            featureidkey=f"properties.{geo_level}",
+            locations=codes[present],
+            z=z,
+            text=regions[present],
+            customdata=values[column][present, None],
+            colorscale=colorscale,
+            showscale=False,
+            hovertemplate='%{text}<br>' + column + f': {unit}' + '%{customdata[0]:' + data_format + '}<extra></extra>'
         )
+        if shared_scale or len(thresholds) > 0:
+            trace.update(zmin=zmin, zmax=zmax, showscale=len(thresholds) == 0 and i == 0)
+            trace.update(colorbar=dict(tickformat=data_format, tickprefix=unit))
+        else:
+            # Give each panel its own colour bar, placed against the right edge of its subplot
+            geo = fig.get_subplot(row, col)
+            trace.update(showscale=True, colorbar=dict(
+                tickformat=data_format,
+                tickprefix=unit,
+                x=geo.domain.x[1],
+                y=sum(geo.domain.y) / 2,
+                len=(geo.domain.y[1] - geo.domain.y[0]) * 0.9,
+                thickness=10
+            ))
+        add_geo_trace(fig, trace, geojson, row=row, col=col)
 
+    if len(thresholds) > 0:
+        add_threshold_legend(fig, thresholds, colorscale, data_format, unit)
 
-    # Update layout
     fig.update_geos(
         resolution=50,
-        projection_type= "mercator", #orthographic", #play with this, note that for some projection types, the height/width ratio is fixed    
-        framewidth = 1,
-        showframe = False, #shows border around subplots
-        coastlinecolor = '#d9d9d9',
-        fitbounds="locations",  
-        visible=False  # Hide default geographic features              
-        )
-    
+        projection_type="mercator",
+        showframe=False,
+        fitbounds="locations",
+        visible=False
+    )
     fig.update_layout(
-        title=wrap_title(column, max_length=100),
-        margin={"r":0,"t":50,"l":0,"b":0},  # Adjust margins
-        height = height,
-        width = 800
+        margin={"r": 0, "t": 50, "l": 0, "b": 0},
+        height=height * nrows / 1.5,
+        width=800
     )
+    if len(thresholds) > 0:
+        fig.update_layout(margin=dict(r=200))
+    return fig
+
+# Overlay (already clustered) points on a map, sizing each marker by the number of points it stands for
+def add_point_overlay(fig, clusters, name='Points', colour='#d62728', renderer='geo'):
+    counts = clusters['count'].to_numpy()
+    sizes = 4 + 16 * np.sqrt(counts / counts.max()) if len(counts) > 0 else []
+    if renderer == 'map':
+        scatter, marker = go.Scattermap, dict(size=sizes, color=colour, opacity=0.7)  # WebGL markers have no outline
+    else:
+        scatter, marker = go.Scattergeo, dict(size=sizes, color=colour, opacity=0.7, line=dict(width=0.5, color='white'))
+    fig.add_trace(scatter(
+        lon=clusters['lon'],
+        lat=clusters['lat'],
+        mode='markers',
+        marker=marker,
+        customdata=counts,
+        name=name,
+        showlegend=False,
+        hovertemplate=f'{name}: ' + '%{customdata:,}<extra></extra>'
+    ))
     return fig
\ No newline at end of file
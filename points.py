@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+# Coordinate systems point locations can be uploaded in
+POINT_CRS = {
+    'Latitude/longitude': 'EPSG:4326',
+    'Easting/northing': 'EPSG:27700'  # British National Grid
+}
+
+# Points this far (in degrees, roughly 1km) outside the generalised coastline are snapped to the nearest region
+MAX_SNAP_DISTANCE = 0.01
+
+# Read the x/y columns as numbers and turn them into point geometries in the boundaries' CRS
+def make_points(df, x_col, y_col, crs='EPSG:4326', target_crs='EPSG:4326'):
+    x = pd.to_numeric(df[x_col], errors='coerce').to_numpy(dtype=float)
+    y = pd.to_numeric(df[y_col], errors='coerce').to_numpy(dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if crs != target_crs:
+        transformer = Transformer.from_crs(crs, target_crs, always_xy=True)
+        x[valid], y[valid] = transformer.transform(x[valid], y[valid])
+    points = shapely.points(x[valid], y[valid])
+    return points, valid
+
+# Assign every point to the region containing it, using an STRtree over the region shapes so all points are tested in one query
+def assign_points(points, shapes_df, code_col):
+    geometries = shapes_df.geometry.values
+    codes = shapes_df[code_col].to_numpy()
+    shapely.prepare(geometries)
+    tree = shapely.STRtree(geometries)
+    point_idx, shape_idx = tree.query(points, predicate='within')
+    # A point on a shared border can match two regions, keep the first match
+    point_idx, first = np.unique(point_idx, return_index=True)
+    assigned = np.full(len(points), None, dtype=object)
+    assigned[point_idx] = codes[shape_idx[first]]
+
+    # Points just off the simplified coastline are given to the nearest region
+    unmatched = np.flatnonzero(pd.isna(assigned))
+    if len(unmatched) > 0:
+        near_point_idx, near_shape_idx = tree.query(points[unmatched], predicate='dwithin', distance=MAX_SNAP_DISTANCE)
+        distances = shapely.distance(points[unmatched][near_point_idx], geometries[near_shape_idx])
+        # Sort by point then distance so the first match for each point is its closest region
+        order = np.lexsort((distances, near_point_idx))
+        near_point_idx, first = np.unique(near_point_idx[order], return_index=True)
+        assigned[unmatched[near_point_idx]] = codes[near_shape_idx[order][first]]
+    return assigned
+
+# Roll base level codes (ITL3 or LA) up to the requested level using the mapping files
+def map_codes_to_level(codes, level, itlmapping, mcamapping):
+    codes = pd.Series(codes, dtype=object)
+    if level in ['itl3', 'la']:
+        return codes
+    if level[:3] == 'itl':
+        lookup = itlmapping.drop_duplicates('itl3').set_index('itl3')[level]
+    else:
+        lookup = mcamapping.dropna(subset=['mca']).drop_duplicates('la').set_index('la')['mca']
+    return codes.map(lookup)
+
+# Assign points to regions at the given level and aggregate them (count, sum or mean) into a table the map tool can read.
+# Boundary files can hold more than one vintage of regions, overlapping each other; with current_codes the points are
+# only assigned to those regions, so none are counted in a retired region instead of the one that replaced it
+def aggregate_points(df, x_col, y_col, crs, level, how, value_cols, shapes_df, code_col, itlmapping, mcamapping, current_codes=None):
+    if current_codes is not None:
+        shapes_df = shapes_df[shapes_df[code_col].isin(current_codes)]
+    points, valid = make_points(df, x_col, y_col, crs, shapes_df.crs.to_string())
+    base_codes = assign_points(points, shapes_df, code_col)
+    codes = map_codes_to_level(base_codes, level, itlmapping, mcamapping)
+
+    located = df.loc[valid].reset_index(drop=True)
+    located[level] = codes.to_numpy()
+    # Points outside every region, and points in a region that isn't part of one at the level (e.g. outside every MCA)
+    placed = ~pd.isna(base_codes)
+    unassigned = int((~placed).sum()) + int((~valid).sum())
+    outside_level = int((placed & located[level].isna().to_numpy()).sum())
+    located = located.dropna(subset=[level])
+
+    grouped = located.groupby(level)
+    if how == 'count' or not value_cols:
+        aggregated = grouped.size().to_frame('Number of points')
+    else:
+        values = located[value_cols].apply(pd.to_numeric, errors='coerce')
+        values[level] = located[level]
+        aggregated = values.groupby(level).agg(how)
+        aggregated.columns = [f'{col} ({how})' for col in value_cols]
+        aggregated['Number of points'] = grouped.size()
+    return aggregated.reset_index(), unassigned, outside_level
+
+# Most markers a point overlay will ever send to the browser at the default map size
+MAX_MARKERS = 2000
+
+# Size (in degrees) of the smallest grid cell used to cluster overlay points, each level above doubles it
+FINEST_CELL = 0.005
+
+# Precompute grid clusters for every zoom level at once. Level 0 is the raw points, level k groups points into
+# cells of FINEST_CELL * 2 ** (k - 1) degrees, built by merging the cells of the level below
+def build_cluster_levels(df, x_col, y_col, crs='EPSG:4326', levels=12):
+    points, valid = make_points(df, x_col, y_col, crs)
+    lon, lat = shapely.get_x(points), shapely.get_y(points)
+    cluster_levels = [pd.DataFrame({'lon': lon, 'lat': lat, 'count': np.ones(len(lon), dtype=int)})]
+
+    cells = pd.DataFrame({
+        'ix': np.floor(lon / FINEST_CELL).astype(np.int64),
+        'iy': np.floor(lat / FINEST_CELL).astype(np.int64),
+        'lon': lon,
+        'lat': lat,
+        'count': 1
+    })
+    for level in range(1, levels + 1):
+        if level > 1:
+            cells['ix'] //= 2
+            cells['iy'] //= 2
+        # Weight the coordinates by count so merged cells sit at the centre of their points
+        cells['lon'] *= cells['count']
+        cells['lat'] *= cells['count']
+        cells = cells.groupby(['ix', 'iy'], as_index=False, sort=False).sum()
+        cells['lon'] /= cells['count']
+        cells['lat'] /= cells['count']
+        cluster_levels.append(cells[['lon', 'lat', 'count']].copy())
+        if len(cells) == 1:
+            break
+    return cluster_levels
+
+# Pick the finest clustering that fits the marker budget for the size of the map being drawn
+def choose_cluster_level(cluster_levels, map_height=550, max_markers=MAX_MARKERS):
+    budget = max(int(max_markers * (map_height / 550) ** 2), 1)
+    for clusters in cluster_levels:
+        if len(clusters) <= budget:
+            return clusters
+    return cluster_levels[-1]
@@ -0,0 +1,53 @@
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Background work is capped for the whole server, not per session, so prefetching can't crowd out foreground renders
+MAX_WORKERS = 2
+# Most prefetch jobs a session can have queued at once
+MAX_JOBS = 6
+# Datasets whose column choices are counted; the least recently used are forgotten past this
+MAX_DATASETS = 64
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='prefetch')
+_lock = threading.Lock()
+_pending = {}  # session id -> (generation, futures)
+_popularity = OrderedDict()  # dataset -> Counter of column -> number of times chosen, across all sessions
+
+# Count a column being chosen so popular columns are prefetched first for everyone using the dataset
+def record_choice(dataset, column):
+    with _lock:
+        _popularity.setdefault(dataset, Counter())[column] += 1
+        _popularity.move_to_end(dataset)
+        if len(_popularity) > MAX_DATASETS:
+            _popularity.popitem(last=False)
+
+# Columns of a dataset ordered by how often they have been chosen
+def popular_columns(dataset, columns):
+    with _lock:
+        chosen = _popularity.get(dataset, Counter())
+        counts = {column: chosen[column] for column in columns}
+    return [column for column in sorted(columns, key=lambda column: -counts[column]) if counts[column] > 0]
+
+# Queue a session's prefetch jobs. generation identifies the dataset and style the jobs were built for: when it
+# changes the session's queued jobs are cancelled (jobs already running finish, but are bounded by MAX_WORKERS)
+def schedule(session_id, generation, jobs):
+    with _lock:
+        current = _pending.get(session_id)
+        if current is not None and current[0] == generation:
+            return False
+        if current is not None:
+            for future in current[1]:
+                future.cancel()
+        # Forget sessions whose work has all finished
+        for finished in [key for key, (_, futures) in _pending.items() if all(future.done() for future in futures)]:
+            del _pending[finished]
+        _pending[session_id] = (generation, [_executor.submit(_run, function, args) for function, args in jobs[:MAX_JOBS]])
+    return True
+
+# Prefetching is best effort: a failed job just means the foreground render does the work instead
+def _run(function, args):
+    try:
+        function(*args)
+    except Exception:
+        pass
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+HISTOGRAM_BINS = 20
+
+# Clean every metric column of a dataset in one go (same rules as map.clean_values), indexed by region code
+def clean_metrics(df):
+    metrics = df.iloc[:, 1:].copy()
+    # Columns pandas already read as numbers don't need the string clean up
+    text_columns = [column for column in metrics.columns if not pd.api.types.is_numeric_dtype(metrics[column]) or pd.api.types.is_bool_dtype(metrics[column])]
+    if text_columns:
+        text = metrics[text_columns].astype(str).replace(r"[^\d.-]", "", regex=True)
+        metrics[text_columns] = text.apply(pd.to_numeric, errors='coerce')
+    # Infinite values (e.g. divisions by zero in the source data) can't be coloured, so treat them as missing
+    metrics = metrics.astype(float).replace([np.inf, -np.inf], np.nan)
+    metrics.index = df.iloc[:, 0]
+    return metrics
+
+# Profile every metric column at once: counts, range, quantiles, mean, top/bottom regions and a histogram.
+# Everything is computed on the whole 2D array of values so the cost doesn't grow with repeated column lookups
+def profile_dataset(df, top_n=5):
+    metrics = clean_metrics(df)
+    values = metrics.to_numpy(dtype=float)
+    columns = list(metrics.columns)
+    codes = metrics.index.to_numpy()
+    present = ~np.isnan(values)
+
+    stats = pd.DataFrame({
+        'count': present.sum(axis=0),
+        'missing': (~present).sum(axis=0),
+        'min': metrics.min().to_numpy(),
+        'max': metrics.max().to_numpy(),
+        'mean': metrics.mean().to_numpy()
+    }, index=columns)
+    quantiles = metrics.quantile(QUANTILES).T
+    quantiles.columns = [f'p{int(q * 100)}' for q in QUANTILES]
+    stats = stats.join(quantiles)
+
+    # Rank each column with missing values pushed to the end either way round
+    descending = np.argsort(np.where(present, -values, np.inf), axis=0, kind='stable')
+    ascending = np.argsort(np.where(present, values, np.inf), axis=0, kind='stable')
+
+    # Histogram of every column: bin indexes for the whole array, offset per column and counted with one bincount
+    lows, highs = stats['min'].to_numpy(), stats['max'].to_numpy()
+    spans = np.where(highs > lows, highs - lows, 1)
+    bins = np.clip(np.floor((values - lows) / spans * HISTOGRAM_BINS), 0, HISTOGRAM_BINS - 1)
+    offsets = np.arange(len(columns)) * HISTOGRAM_BINS
+    flat_bins = (np.where(present, bins, 0) + offsets).astype(int)[present]
+    counts = np.bincount(flat_bins, minlength=len(columns) * HISTOGRAM_BINS).reshape(len(columns), HISTOGRAM_BINS)
+
+    profile = {'stats': stats, 'top': {}, 'bottom': {}, 'histograms': {}}
+    for i, column in enumerate(columns):
+        n = min(top_n, stats['count'].iloc[i])
+        profile['top'][column] = pd.Series(values[descending[:n, i], i], index=codes[descending[:n, i]])
+        profile['bottom'][column] = pd.Series(values[ascending[:n, i], i], index=codes[ascending[:n, i]])
+        edges = np.linspace(lows[i], highs[i], HISTOGRAM_BINS + 1) if stats['count'].iloc[i] > 0 else np.zeros(HISTOGRAM_BINS + 1)
+        profile['histograms'][column] = pd.Series(counts[i], index=edges[:-1])
+    return profile
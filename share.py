@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import zlib
+import base64
+import pickle
+import disk_cache
+
+'''
+Links to a map as it is styled, for maps made from uploaded data as well as the pre-existing datasets.
+
+A shared dataset is stored once under a hash of its contents (so sharing the same data twice stores it once), and the
+link carries that hash and the style: colours, discrete thresholds, geography level, column, units, decimal places,
+size and map type, as compressed JSON. Opening the link rebuilds exactly the inputs the map was drawn from, so its
+figure comes straight from the figure cache instead of being built again.
+
+Datasets are kept in MAP_SHARE_DIR, by default a folder in the on-disk cache's directory (shared by every replica) or
+`shared/` when that isn't set. They are stored apart from the cache so evicting old maps doesn't break links, but the
+store is bounded too: a dataset can be at most MAP_SHARE_MAX_DATASET_MB stored, and past MAP_SHARE_MAX_MB in total the datasets
+least recently shared or opened are removed, after which their links say the data is no longer available.
+'''
+
+SHARE_DIR = os.environ.get('MAP_SHARE_DIR') or (os.path.join(disk_cache.CACHE_DIR, 'datasets') if disk_cache.CACHE_DIR else 'shared')
+MAX_BYTES = int(float(os.environ.get('MAP_SHARE_MAX_MB', 1024)) * 1024 * 1024)
+MAX_DATASET_BYTES = int(float(os.environ.get('MAP_SHARE_MAX_DATASET_MB', 20)) * 1024 * 1024)
+# Hex characters of the content hash kept in links (96 bits)
+KEY_LENGTH = 24
+UNITS = ['None', '%', '£', '$', '€']
+RENDERERS = ['geo', 'map', 'hex']
+# Geography levels the level selector can offer
+LEVELS = {'ITL1', 'ITL2', 'ITL3', 'LA', 'MCA', 'National'}
+# Short names used in the link for each style setting
+STYLE_FIELDS = {'unit': 'u', 'dp': 'd', 'size': 's', 'renderer': 'r', 'hide_missing': 'h', 'colours': 'c', 'thresholds': 't', 'levels': 'ls', 'level': 'l', 'index': 'i'}
+
+def dataset_key(df):
+    return disk_cache.make_key('dataset', df).split(':')[1][:KEY_LENGTH]
+
+def dataset_path(key):
+    if not re.fullmatch(f'[0-9a-f]{{{KEY_LENGTH}}}', key or ''):
+        raise ValueError("The shared map link isn't valid")
+    return os.path.join(SHARE_DIR, f'{key}.pkl')
+
+# Store a dataset under its content hash, if it isn't already, and return the hash. Raises ValueError with a message
+# for the user if the dataset is too large to share
+def save_dataset(df):
+    key = dataset_key(df)
+    path = dataset_path(key)
+    if os.path.exists(path):
+        os.utime(path)  # Shared again, so kept longer
+        return key
+    data = zlib.compress(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    if len(data) > MAX_DATASET_BYTES:
+        raise ValueError(f"This dataset is too large to share (over {MAX_DATASET_BYTES // 1024 ** 2}MB compressed)")
+    os.makedirs(SHARE_DIR, exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)  # Atomic, so another replica never reads half a file
+    evict(keep=path)
+    return key
+
+def load_dataset(key):
+    path = dataset_path(key)
+    try:
+        with open(path, 'rb') as f:
+            df = pickle.loads(zlib.decompress(f.read()))
+        os.utime(path)  # Opened, so kept longer
+        return df
+    except FileNotFoundError:
+        raise ValueError("The data for this shared map is no longer available")
+
+# Remove the datasets least recently shared or opened until the store is back under 90% of its size limit, apart from
+# keep (the one just shared)
+def evict(keep=None):
+    entries = []
+    for entry in os.scandir(SHARE_DIR):
+        if entry.name.endswith('.pkl'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Removed by another replica
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_BYTES * 0.9:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# Style settings -> compact text for a link
+def encode_style(style):
+    short = {STYLE_FIELDS[name]: value for name, value in style.items() if value is not None}
+    if 'c' in short:
+        short['c'] = [colour.lstrip('#') for colour in short['c']]
+    data = zlib.compress(json.dumps(short, separators=(',', ':'), ensure_ascii=False).encode(), 9)
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+# Style settings from a link, checked so a hand edited link can only give settings the sidebar accepts
+def decode_style(text):
+    try:
+        short = json.loads(zlib.decompress(base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))))
+        style = {name: short[field] for name, field in STYLE_FIELDS.items() if field in short}
+        if 'colours' in style:
+            style['colours'] = ['#' + colour for colour in style['colours']]
+        valid = (
+            style.get('unit', 'None') in UNITS
+            and not isinstance(style.get('dp', 0), bool) and style.get('dp', 0) in range(6)
+            and 0.25 <= float(style.get('size', 1)) <= 2
+            and style.get('renderer', 'geo') in RENDERERS
+            and isinstance(style.get('hide_missing', False), bool)
+            and 2 <= len(style.get('colours', ['#000000'] * 2)) <= 6
+            and all(re.fullmatch('#[0-9a-fA-F]{6}', colour) for colour in style.get('colours', []))
+            and ('thresholds' not in style or len(style['thresholds']) == len(style.get('colours', [])) + 1)
+            and all(isinstance(value, (int, float)) for value in style.get('thresholds', []))
+            and all(low < high for low, high in zip(style.get('thresholds', []), style.get('thresholds', [])[1:]))
+            and isinstance(style.get('levels', []), list)
+            and all(isinstance(level, str) and level in LEVELS for level in style.get('levels', []))
+            and ('level' not in style or (isinstance(style['level'], str) and style['level'] in (style.get('levels') or LEVELS)))
+            and isinstance(style.get('index', 0), int) and not isinstance(style.get('index', 0), bool)
+        )
+    except (ValueError, TypeError, AttributeError, zlib.error):
+        valid = False
+    if not valid:
+        raise ValueError("The shared map link isn't valid")
+    return style
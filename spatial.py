@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+'''
+Spatial statistics: whether high (or low) values on a map cluster together, with global Moran's I for a column and
+local Moran's I (LISA) picking out its hot spots (high values among high neighbours) and cold spots.
+
+Neighbours come from the boundaries. With queen contiguity regions that touch at all are neighbours, with rook
+contiguity only regions sharing a stretch of border are. Neighbour lists are built once per map level and kept as
+flat arrays of (region, neighbour) positions sorted by region, i.e. a sparse matrix in CSR order, so the spatial lag
+of a column (or of every permutation of it at once) is a gather and a segmented sum rather than polygon tests.
+'''
+
+# Boundaries this close (in degrees, about 10m) count as touching, which bridges the slivers simplification leaves
+TOLERANCE = 1e-4
+# With rook contiguity, neighbours must share more border than this (in degrees) rather than meet at a corner
+ROOK_MIN_SHARED = 10 * TOLERANCE
+# Cluster labels, in the order they are coded in the results and on hot spot maps
+CLUSTERS = ['Not significant', 'High-High', 'Low-Low', 'High-Low', 'Low-High']
+# Local permutations are run in blocks of this many to bound memory on the larger levels
+PERMUTATION_BLOCK = 100
+
+# Neighbour pairs for every region of a map layer. Islands (no region within reach) are joined to their nearest region
+# so every region has a neighbour, as is usual for UK regions such as Northern Ireland, Anglesey and the Isle of Wight
+def contiguity_weights(map_df, code_col, contiguity='queen'):
+    geometries = np.asarray(map_df.geometry.array)
+    left, right = map_df.sindex.query(geometries, predicate='dwithin', distance=TOLERANCE)
+    left, right = left[left != right], right[left != right]
+    if contiguity == 'rook':
+        # Length of each neighbour's border running inside the region's (slightly widened) outline
+        widened = shapely.buffer(geometries, TOLERANCE)
+        shared = shapely.length(shapely.intersection(widened[left], shapely.boundary(geometries[right])))
+        left, right = left[shared > ROOK_MIN_SHARED], right[shared > ROOK_MIN_SHARED]
+    isolated = np.setdiff1d(np.arange(len(geometries)), left)
+    if len(isolated) > 0 and len(geometries) > 1:
+        source, nearest = map_df.sindex.nearest(geometries[isolated], return_all=False, exclusive=True)
+        left = np.concatenate([left, isolated[source], nearest])
+        right = np.concatenate([right, nearest, isolated[source]])
+    pairs = np.unique(np.column_stack([left, right]), axis=0)  # Symmetric, without repeats, sorted by region
+    return {'codes': map_df[code_col].to_numpy(), 'left': pairs[:, 0], 'right': pairs[:, 1]}
+
+# Row standardised spatial lag (mean of the neighbours' values) of the last axis of z, over sorted neighbour pairs
+def spatial_lag(z, left, right, counts):
+    lag = np.zeros(z.shape)
+    connected = counts > 0
+    if connected.any():
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[connected]
+        lag[..., connected] = np.add.reduceat(z[..., right], starts, axis=-1) / counts[connected]
+    return lag
+
+# Pseudo p-value of observed statistics against permuted ones (permutations on axis 0), taking the nearer tail
+def permutation_p_values(observed, permuted):
+    larger = (permuted >= observed).sum(axis=0)
+    larger = np.minimum(larger, len(permuted) - larger)
+    return (larger + 1) / (len(permuted) + 1)
+
+# Global and local Moran's I for a column of values indexed by region code. Only regions with values take part,
+# neighbours without values are ignored. Significance is by permutation: shuffling the values over the regions for the
+# global statistic, and shuffling the other values over each region's neighbours (conditional randomisation) for the
+# local ones. Returns None when there are too few regions or the values don't vary
+def spatial_autocorrelation(values, weights, permutations=999, significance=0.05, seed=0):
+    values = values.dropna()
+    values = values[~values.index.duplicated()]
+    n = len(values)
+    if n < 3 or values.nunique() < 2:
+        return None
+    position = pd.Series(np.arange(n), index=values.index)
+    left = position.reindex(weights['codes'][weights['left']]).to_numpy()
+    right = position.reindex(weights['codes'][weights['right']]).to_numpy()
+    keep = ~(np.isnan(left) | np.isnan(right)) & (left != right)
+    # A code can be on more than one row of a layer, so pairs are made unique again (which also sorts them by region)
+    pairs = np.unique(np.column_stack([left[keep], right[keep]]).astype(int).reshape(-1, 2), axis=0)
+    left, right = pairs[:, 0], pairs[:, 1]
+    counts = np.bincount(left, minlength=n)
+    connected = counts > 0
+    if not connected.any():
+        return None
+
+    rng = np.random.default_rng(seed)
+    z = values.to_numpy(dtype=float) - values.mean()
+    m2 = (z ** 2).sum() / n
+    lag = spatial_lag(z, left, right, counts)
+
+    # Global: with row standardised weights the weights sum to the number of regions with neighbours
+    scale = n / connected.sum() / (z ** 2).sum()
+    moran_i = scale * (z * lag).sum()
+    shuffled = rng.permuted(np.tile(z, (permutations, 1)), axis=1)
+    permuted_i = scale * (shuffled * spatial_lag(shuffled, left, right, counts)).sum(axis=1)
+    larger = (permuted_i >= moran_i).sum()
+
+    # Local: each region's value against the mean of its neighbours'. As in PySAL's conditional randomisation, each
+    # permutation draws one set of other regions without replacement and every region takes the first of them it needs,
+    # with positions from its own onwards shifted by one so a region is never its own neighbour
+    local_i = z * lag / m2
+    kmax = counts.max()
+    draws = np.argsort(rng.random((permutations, n - 1)), axis=1)[:, :kmax]
+    used = np.arange(kmax)[None, :] < counts[:, None]
+    permuted_local = []
+    for start in range(0, permutations, PERMUTATION_BLOCK):
+        block = draws[start:start + PERMUTATION_BLOCK, None, :]
+        drawn = block + (block >= np.arange(n)[None, :, None])
+        permuted_lag = np.where(used, z[drawn], 0).sum(axis=-1) / np.maximum(counts, 1)
+        permuted_local.append(z * permuted_lag / m2)
+    local_p = permutation_p_values(local_i, np.concatenate(permuted_local))
+
+    quadrant = np.select([(z > 0) & (lag > 0), (z < 0) & (lag < 0), (z > 0) & (lag < 0), (z < 0) & (lag > 0)], [1, 2, 3, 4], 0)
+    cluster = np.where((local_p <= significance) & connected, quadrant, 0)
+    return {
+        'moran': {
+            'i': float(moran_i),
+            'expected': -1 / (n - 1),
+            'p_value': float((min(larger, permutations - larger) + 1) / (permutations + 1)),
+            'z_score': float((moran_i - permuted_i.mean()) / permuted_i.std()) if permuted_i.std() > 0 else 0.0,
+            'regions': n,
+            'mean_neighbours': float(counts[connected].mean())
+        },
+        'local': pd.DataFrame({'local_i': local_i, 'p_value': np.where(connected, local_p, np.nan), 'cluster': cluster}, index=values.index)
+    }
@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+import derived
+
+COLUMNS = ('A', 'B')
+
+def test_evaluates_column_arithmetic():
+    df = pd.DataFrame({'code': ['TLC', 'TLD'], 'A': [1.0, 4.0], 'B': [2.0, 2.0]})
+    compiled, used = derived.compile_expression('`A` / `B` + `A` ** 2', COLUMNS)
+    assert derived.evaluate_expression(df, compiled, used).tolist() == [1.5, 18.0]
+
+@pytest.mark.parametrize('expression', [
+    '`A` + 9 ** 9 ** 8',
+    '`A` ** (9 ** 9)',
+    '`A` + ((9 ** 100) ** 100) ** 100',
+    '`A` ** 1000',
+])
+def test_rejects_unbounded_constant_powers(expression):
+    with pytest.raises(ValueError):
+        derived.compile_expression(expression, COLUMNS)
+
+@pytest.mark.parametrize('expression', ['`A` ** 2', '2 ** `A`', '`A` ** `B`', '`A` * 10 ** -3'])
+def test_allows_bounded_powers(expression):
+    derived.compile_expression(expression, COLUMNS)
+
+@pytest.mark.parametrize('expression', ['`A` + c1', 'c0 + 1', '`A` + `B` + c2'])
+def test_rejects_typed_placeholders(expression):
+    with pytest.raises(ValueError):
+        derived.compile_expression(expression, COLUMNS)
+
+def test_evaluation_errors_are_value_errors():
+    df = pd.DataFrame({'code': ['TLC'], 'A': [1.0], 'B': [2.0]})
+    with pytest.raises(ValueError):
+        derived.evaluate_expression(df, 'c0 + c5', ('A',))